@@ -0,0 +1,318 @@
+from __future__ import print_function
+import io
+import sys
+import json
+import time
+import random
+import argparse
+import traceback
+import platform
+import resource
+import multiprocessing
+import queue as queue_module
+
+from .program import Program
+from .vector import numpy, columns_from, execute_vector
+
+
+def gen_add_tree(n):
+	"""
+	Balanced tree of additions over `n` inputs
+	"""
+	lines = ["input %d" % (_,) for _ in range(n)]
+	level = list(range(n))
+	wire = n
+	while len(level) > 1:
+		next_level = []
+		for i in range(0, len(level) - 1, 2):
+			lines.append("add in 2 <%d %d> out 1 <%d>" % (level[i], level[i + 1], wire))
+			next_level.append(wire)
+			wire += 1
+		if len(level) % 2:
+			next_level.append(level[-1])
+		level = next_level
+	lines.append("output %d" % (level[0],))
+	return wire, lines, {str(_): random.getrandbits(64) for _ in range(n)}
+
+
+def gen_mul_chain(n):
+	"""
+	Chain of `n` dependent multiplications
+	"""
+	lines = ["input 0", "input 1"]
+	for i in range(n):
+		lines.append("mul in 2 <%d 1> out 1 <%d>" % (i + 1 if i else 0, i + 2))
+	lines.append("output %d" % (n + 1,))
+	return n + 2, lines, {'0': random.getrandbits(64), '1': random.getrandbits(64)}
+
+
+def gen_split(n, bits=254):
+	"""
+	`n` inputs each split into `bits` bits, then packed back together
+	"""
+	lines = ["input %d" % (_,) for _ in range(n)]
+	wire = n
+	for i in range(n):
+		outputs = list(range(wire, wire + bits))
+		wire += bits
+		lines.append("split in 1 <%d> out %d <%s>" % (i, bits, ' '.join(str(_) for _ in outputs)))
+		lines.append("pack in %d <%s> out 1 <%d>" % (bits, ' '.join(str(_) for _ in outputs), wire))
+		lines.append("output %d" % (wire,))
+		wire += 1
+	return wire, lines, {str(_): random.getrandbits(bits - 1) for _ in range(n)}
+
+
+def gen_table(n, bits=4):
+	"""
+	`n` lookup tables of `bits` inputs, each with different contents
+	"""
+	lines = ["input %d" % (_,) for _ in range(bits)]
+	wire = bits
+	for i in range(n):
+		lut = ' '.join(str(random.getrandbits(64)) for _ in range(2**bits))
+		inputs = ' '.join(str(_) for _ in range(bits))
+		lines.append("table %d <%s> in <%s> out <%d>" % (2**bits, lut, inputs, wire))
+		lines.append("output %d" % (wire,))
+		wire += 1
+	return wire, lines, {str(_): random.getrandbits(1) for _ in range(bits)}
+
+
+def gen_comparator(n, bits=128):
+	"""
+	Running maximum of `n` inputs, as in the auction example, where each
+	comparison splits the difference of two values to find its sign
+	"""
+	one = n
+	lines = ["input %d" % (_,) for _ in range(n + 1)]
+	lines.append("const-mul-%x in 1 <%d> out 1 <%d>" % (2**bits, one, n + 1))
+	best = 0
+	wire = n + 2
+	for i in range(1, n):
+		neg, diff = wire, wire + 1
+		lines.append("const-mul-neg-1 in 1 <%d> out 1 <%d>" % (best, neg))
+		lines.append("add in 3 <%d %d %d> out 1 <%d>" % (i, neg, n + 1, diff))
+		split = list(range(wire + 2, wire + 3 + bits))
+		lines.append("split in 1 <%d> out %d <%s>" % (diff, bits + 1, ' '.join(str(_) for _ in split)))
+		greater = split[-1]
+		wire = split[-1] + 1
+		lines.append("mul in 2 <%d %d> out 1 <%d>" % (greater, i, wire))
+		lines.append("const-mul-neg-1 in 1 <%d> out 1 <%d>" % (greater, wire + 1))
+		lines.append("add in 2 <%d %d> out 1 <%d>" % (one, wire + 1, wire + 2))
+		lines.append("mul in 2 <%d %d> out 1 <%d>" % (wire + 2, best, wire + 3))
+		lines.append("add in 2 <%d %d> out 1 <%d>" % (wire, wire + 3, wire + 4))
+		best = wire + 4
+		wire += 5
+	lines.append("output %d" % (best,))
+	inputs = {str(_): random.getrandbits(bits - 1) for _ in range(n)}
+	inputs[str(one)] = 1
+	return wire, lines, inputs
+
+
+SHAPES = {
+	'add-tree': gen_add_tree,
+	'mul-chain': gen_mul_chain,
+	'split': gen_split,
+	'table': gen_table,
+	'comparator': gen_comparator,
+}
+
+# Default size of each shape, chosen so every benchmark takes a similar time
+SIZES = {
+	'add-tree': 20000,
+	'mul-chain': 20000,
+	'split': 100,
+	'table': 1000,
+	'comparator': 100,
+}
+
+
+# The count each timing's throughput is reported in
+UNITS = {
+	'parse': 'lines',
+	'setup': 'commands',
+	'run': 'commands',
+	'constraints': 'constraints',
+	'compile': 'commands',
+	'run_tape': 'commands',
+	'batch': 'witnesses',
+	'vector': 'witnesses',
+}
+
+# Number of witnesses evaluated by the batch and vector timings
+BATCH_SIZE = 64
+
+
+def generate(shape, size):
+	"""
+	Returns the text of a synthetic circuit, and values for its inputs
+	"""
+	total, lines, inputs = SHAPES[shape](size)
+	return "total %d\n%s\n" % (total, '\n'.join(lines)), inputs
+
+
+def timed(func, repeat):
+	"""
+	Returns the result of the function, and the best time of `repeat` calls
+	"""
+	best = None
+	for _ in range(repeat):
+		begin = time.perf_counter()
+		result = func()
+		elapsed = time.perf_counter() - begin
+		best = elapsed if best is None else min(best, elapsed)
+	return result, best
+
+
+def measure(shape, size, repeat, compact):
+	random.seed(size)
+	text, inputs = generate(shape, size)
+	n_lines = text.count('\n')
+
+	def parse():
+		return Program.from_lines(io.StringIO(text), compact)
+
+	_, t_parse = timed(parse, repeat)
+	t_setup = None
+	for _ in range(repeat):
+		# Setup modifies the program, so each timing needs a freshly parsed one
+		program = parse()
+		_, elapsed = timed(program.setup, 1)
+		t_setup = elapsed if t_setup is None else min(t_setup, elapsed)
+	program.set_values(inputs)
+	_, t_run = timed(program.run, repeat)
+	n_constraints, t_constraints = timed(lambda: sum(1 for _ in program.constraints()), repeat)
+	_, t_compile = timed(program.compile, 1)
+	_, t_tape = timed(program.run, repeat)
+
+	# The tape evaluated for a batch of witnesses one at a time, then vectorised
+	tape = program.tape
+	template = tape.load(program.state)
+	_, t_batch = timed(lambda: [tape.execute(list(template)) for _ in range(BATCH_SIZE)], repeat)
+	t_vector = None
+	if numpy is not None:
+		_, t_vector = timed(lambda: execute_vector(tape, columns_from(template, BATCH_SIZE), BATCH_SIZE), repeat)
+
+	n_commands = len(program.commands)
+	return {
+		'shape': shape,
+		'size': size,
+		'compact': compact,
+		'lines': n_lines,
+		'commands': n_commands,
+		'constraints': n_constraints,
+		'witnesses': BATCH_SIZE,
+		'seconds': {
+			'parse': t_parse,
+			'setup': t_setup,
+			'run': t_run,
+			'constraints': t_constraints,
+			'compile': t_compile,
+			'run_tape': t_tape,
+			'batch': t_batch,
+			'vector': t_vector,
+		},
+		'throughput': {
+			'parse_lines': n_lines / max(t_parse, 1e-9),
+			'setup_commands': n_commands / max(t_setup, 1e-9),
+			'run_commands': n_commands / max(t_run, 1e-9),
+			'constraints': n_constraints / max(t_constraints, 1e-9),
+			'compile_commands': n_commands / max(t_compile, 1e-9),
+			'run_tape_commands': n_commands / max(t_tape, 1e-9),
+		},
+		# Kilobytes on Linux, bytes on macOS
+		'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+	}
+
+
+class BenchmarkError(Exception):
+	pass
+
+
+def _measure_child(queue, args):
+	try:
+		queue.put((True, measure(*args)))
+	except Exception:
+		queue.put((False, traceback.format_exc()))
+
+
+def measure_isolated(shape, size, repeat, compact):
+	"""
+	Measure in a separate process, so the peak RSS belongs to one benchmark
+
+	Raises `BenchmarkError` if the measurement fails, or the child exits
+	without reporting a result.
+	"""
+	context = multiprocessing.get_context('fork')
+	queue = context.Queue()
+	child = context.Process(target=_measure_child, args=(queue, (shape, size, repeat, compact)))
+	child.start()
+	while True:
+		try:
+			ok, result = queue.get(timeout=1)
+			break
+		except queue_module.Empty:
+			if not child.is_alive():
+				child.join()
+				raise BenchmarkError("Benchmark %s exited with code %r" % (shape, child.exitcode))
+	child.join()
+	if not ok:
+		raise BenchmarkError("Benchmark %s failed:\n%s" % (shape, result))
+	return result
+
+
+def report(result, baseline=None, handle=sys.stdout):
+	print("%-12s size=%-6d %6d commands %7d constraints, peak RSS %d" % (
+		  result['shape'], result['size'], result['commands'], result['constraints'], result['peak_rss']), file=handle)
+	for name, seconds in sorted(result['seconds'].items()):
+		if seconds is None:
+			continue
+		unit = UNITS[name]
+		line = "\t%-12s %9.4fs %12.0f %-15s" % (name, seconds, result[unit] / max(seconds, 1e-9), unit + '/s')
+		if baseline is not None and name in baseline['seconds']:
+			line += "  %+6.1f%%" % (((seconds / baseline['seconds'][name]) - 1) * 100,)
+		print(line.rstrip(), file=handle)
+
+
+def bench_main(argv):
+	parser = argparse.ArgumentParser(prog=argv[0], description="Benchmark parsing, setup, evaluation and constraints of synthetic circuits")
+	parser.add_argument('--shape', action='append', choices=sorted(SHAPES),
+						help="Circuit shapes to benchmark, all of them by default")
+	parser.add_argument('--size', metavar='N', type=int,
+						help="Size of every circuit, otherwise each shape has its own default")
+	parser.add_argument('--repeat', metavar='N', type=int, default=3,
+						help="Report the best of N timings")
+	parser.add_argument('--compact', action='store_true', help="Use dense integer wire indices for the state")
+	parser.add_argument('--output', metavar='FILE', help="Write the results as JSON to the file")
+	parser.add_argument('--compare', metavar='FILE',
+						help="Show the change in timings relative to results previously written with --output")
+	args = parser.parse_args(argv[1:])
+
+	baselines = dict()
+	if args.compare:
+		with open(args.compare, 'r') as handle:
+			for result in json.load(handle)['results']:
+				baselines[(result['shape'], result['size'], result['compact'])] = result
+
+	results = []
+	for shape in args.shape or sorted(SHAPES):
+		size = args.size or SIZES[shape]
+		try:
+			result = measure_isolated(shape, size, args.repeat, args.compact)
+		except BenchmarkError as ex:
+			print("Error: %s" % (ex,), file=sys.stderr)
+			return 2
+		report(result, baselines.get((shape, size, args.compact)))
+		results.append(result)
+
+	if args.output:
+		with open(args.output, 'w') as handle:
+			json.dump({
+				'python': platform.python_version(),
+				'machine': platform.machine(),
+				'results': results,
+			}, handle, indent=2, sort_keys=True)
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(bench_main(sys.argv))
@@ -0,0 +1,219 @@
+from __future__ import print_function
+import sys
+import mmap
+import struct
+from array import array
+
+from ethsnarks.field import SNARK_SCALAR_FIELD
+
+from .parser import parse, GenericStatement, ConstMulStatement, TableStatement, VariableCount, VariableDeclaration
+
+
+MAGIC = b'SNARKIL\x00'
+VERSION = 1
+
+# magic, version, number of words of code, offsets of the constant pool, lut pool and code
+HEADER = struct.Struct('<8sIIQQQ')
+
+TERMS = [
+    'total', 'input', 'output', 'nizkinput',
+    'xor', 'and', 'or', 'add', 'sub', 'mul', 'assert', 'zerop', 'split', 'pack',
+    'const-mul', 'const-mul-neg', 'table',
+]
+
+OPCODES = {term: opcode for opcode, term in enumerate(TERMS)}
+
+
+class BinaryFormatError(Exception):
+    pass
+
+
+def wire_id(idx):
+    try:
+        return int(idx)
+    except ValueError:
+        raise BinaryFormatError("Binary format requires numeric wire IDs, not %r" % (idx,))
+
+
+class BinaryWriter(object):
+    __slots__ = ('handle', 'words', 'constants', 'luts')
+
+    def __init__(self, handle):
+        """
+        Serialises statements into the binary circuit format
+
+        The code is a sequence of little-endian 32bit words, each statement is
+        encoded as `[opcode, n_in, n_out, extra]` followed by the input and output
+        wires. `extra` holds the wire of a declaration, the total for the header,
+        or an index into the constant pool (const-mul) or lookup table pool (table).
+        Constants and lookup tables are de-duplicated, and written after the code.
+        """
+        self.handle = handle
+        self.words = 0
+        self.constants = dict()
+        self.luts = dict()
+        handle.write(b'\x00' * HEADER.size)
+
+    def _constant(self, value):
+        # Table entries may be negative, the pool only holds field elements
+        value = int(value) % SNARK_SCALAR_FIELD
+        if value not in self.constants:
+            self.constants[value] = len(self.constants)
+        return self.constants[value]
+
+    def _lut(self, lut):
+        key = tuple(self._constant(_) for _ in lut)
+        if key not in self.luts:
+            self.luts[key] = len(self.luts)
+        return self.luts[key]
+
+    def _emit(self, opcode, extra, in_vars=(), out_vars=()):
+        record = [opcode, len(in_vars), len(out_vars), extra]
+        record += [wire_id(_) for _ in in_vars]
+        record += [wire_id(_) for _ in out_vars]
+        self.handle.write(struct.pack('<%dI' % (len(record),), *record))
+        self.words += len(record)
+
+    def write(self, stmt):
+        if isinstance(stmt, VariableCount):
+            self._emit(OPCODES['total'], stmt.total)
+        elif isinstance(stmt, VariableDeclaration):
+            self._emit(OPCODES[stmt.term], wire_id(stmt.idx))
+        elif isinstance(stmt, TableStatement):
+            self._emit(OPCODES['table'], self._lut(stmt.lut), stmt.in_vars, stmt.out_vars)
+        elif isinstance(stmt, ConstMulStatement):
+            self._emit(OPCODES[stmt.term], self._constant(stmt.value), stmt.in_vars, stmt.out_vars)
+        elif isinstance(stmt, GenericStatement):
+            self._emit(OPCODES[stmt.term], 0, stmt.in_vars, stmt.out_vars)
+        else:
+            raise BinaryFormatError("Cannot serialise statement %r" % (type(stmt),))
+
+    def finish(self):
+        handle = self.handle
+        code_offset = HEADER.size
+
+        constants_offset = handle.tell()
+        handle.write(struct.pack('<I', len(self.constants)))
+        for value in sorted(self.constants, key=self.constants.get):
+            data = value.to_bytes((value.bit_length() + 7) // 8, 'little')
+            data += b'\x00' * (-len(data) % 4)
+            handle.write(struct.pack('<I', len(data)))
+            handle.write(data)
+
+        luts_offset = handle.tell()
+        handle.write(struct.pack('<I', len(self.luts)))
+        for key in sorted(self.luts, key=self.luts.get):
+            handle.write(struct.pack('<%dI' % (len(key) + 1,), len(key), *key))
+
+        handle.seek(0)
+        handle.write(HEADER.pack(MAGIC, VERSION, self.words, constants_offset, luts_offset, code_offset))
+        handle.seek(0, 2)
+
+
+def write_binary(statements, handle):
+    writer = BinaryWriter(handle)
+    for stmt in statements:
+        writer.write(stmt)
+    writer.finish()
+
+
+def is_binary(path):
+    with open(path, 'rb') as handle:
+        return handle.read(len(MAGIC)) == MAGIC
+
+
+class BinaryCircuit(object):
+    __slots__ = ('_handle', '_mmap', '_view', 'words', 'constants', 'luts')
+
+    def __init__(self, path):
+        """
+        A binary circuit, memory-mapped read-only
+
+        The code is accessed in-place through a memoryview of the mapping, so
+        opening a circuit only reads the header and the constant pools, and any
+        number of processes mapping the same file share one copy of its pages.
+        """
+        self._handle = open(path, 'rb')
+        self._mmap = mmap.mmap(self._handle.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, n_words, constants_offset, luts_offset, code_offset = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise BinaryFormatError("Not a binary circuit")
+        if version != VERSION:
+            raise BinaryFormatError("Unsupported binary circuit version %d" % (version,))
+
+        self._view = memoryview(self._mmap)[code_offset:code_offset + (n_words * 4)]
+        if sys.byteorder == 'little':
+            self.words = self._view.cast('I')
+        else:
+            self.words = array('I', self._view)
+            self.words.byteswap()
+
+        (count,) = struct.unpack_from('<I', self._mmap, constants_offset)
+        offset = constants_offset + 4
+        self.constants = []
+        for _ in range(count):
+            (length,) = struct.unpack_from('<I', self._mmap, offset)
+            offset += 4
+            self.constants.append(int.from_bytes(self._mmap[offset:offset + length], 'little'))
+            offset += length
+
+        (count,) = struct.unpack_from('<I', self._mmap, luts_offset)
+        offset = luts_offset + 4
+        self.luts = []
+        for _ in range(count):
+            (length,) = struct.unpack_from('<I', self._mmap, offset)
+            offset += 4
+            indices = struct.unpack_from('<%dI' % (length,), self._mmap, offset)
+            self.luts.append([self.constants[_] for _ in indices])
+            offset += length * 4
+
+    def statements(self, strings=True):
+        """
+        Decode the statements, wire IDs are strings (as from the text parser)
+        unless `strings` is False, in which case they're integers.
+        """
+        words = self.words
+        n_words = len(words)
+        i = 0
+        while i < n_words:
+            opcode, n_in, n_out, extra = words[i:i + 4]
+            i += 4
+            in_vars = words[i:i + n_in].tolist()
+            i += n_in
+            out_vars = words[i:i + n_out].tolist()
+            i += n_out
+            if strings:
+                in_vars = [str(_) for _ in in_vars]
+                out_vars = [str(_) for _ in out_vars]
+            term = TERMS[opcode]
+            if term == 'total':
+                yield VariableCount(extra)
+            elif opcode < OPCODES['xor']:
+                yield VariableDeclaration(term, str(extra))
+            elif term == 'table':
+                yield TableStatement(self.luts[extra], in_vars, out_vars)
+            elif term == 'const-mul' or term == 'const-mul-neg':
+                yield ConstMulStatement(self.constants[extra], term, in_vars, out_vars)
+            else:
+                yield GenericStatement(term, in_vars, out_vars)
+
+    def close(self):
+        if isinstance(self.words, memoryview):
+            self.words.release()
+        self._view.release()
+        self._mmap.close()
+        self._handle.close()
+
+
+def binary_main(argv):
+    if len(argv) < 3:
+        print("Usage: %s <file.circuit> <file.bin>" % (argv[0],))
+        return 1
+    with open(argv[1], 'r') as handle:
+        with open(argv[2], 'wb') as output:
+            write_binary(parse(handle), output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(binary_main(sys.argv))
@@ -1,12 +1,113 @@
 import operator
 from functools import reduce
 
-from ethsnarks.field import FQ
+from ethsnarks.field import FQ, SNARK_SCALAR_FIELD
 
-from .r1cs import State, Constraint, Combination, Term
+from .r1cs import State, Constraint, Combination, Term, Variable
+from .tape import Tape, OP_LC, OP_MUL, OP_XOR, OP_AND, OP_OR, OP_ZEROP, OP_ASSERT, OP_SPLIT, OP_TABLE, OP_MUX
 from .parser import AbstractStatement, TableStatement, GenericStatement, ConstMulStatement, Line
 
 
+# Field elements for the characters of a binary string, shared by every split
+BIT_VALUES = {'0': FQ(0), '1': FQ(1)}
+
+# Powers of two shared by every pack and split, extended as needed
+_POWERS_OF_TWO = [1]
+
+
+def powers_of_two(n):
+    """
+    Returns the first `n` powers of two, from the shared table
+    """
+    while len(_POWERS_OF_TWO) < n:
+        _POWERS_OF_TWO.append(_POWERS_OF_TWO[-1] << 1)
+    return _POWERS_OF_TWO[:n]
+
+
+def table_index(state, inputs):
+    """
+    Index into a lookup table selected by the binary inputs, least significant first
+    """
+    idx = 0
+    for weight, var_idx in zip(powers_of_two(len(inputs)), inputs):
+        value = int(state.value(var_idx))
+        if value == 1:
+            idx += weight
+        elif value != 0:
+            raise RuntimeError("Variable %r expected to be binary" % (var_idx,))
+    return idx
+
+
+class LookupTable(object):
+    __slots__ = ('values', 'ints', 'pool', '_halves', '_coefficients')
+
+    def __init__(self, ints, pool):
+        """
+        Immutable contents of a lookup table, shared by every table command
+        with the same contents. Obtain instances from `LutPool.intern`.
+        """
+        self.ints = ints
+        self.values = tuple(FQ(_) for _ in ints)
+        self.pool = pool
+        self._halves = None
+        self._coefficients = None
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, idx):
+        return self.values[idx]
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def halves(self):
+        """
+        The lower and upper halves of the table, as selected by its most significant bit
+        """
+        if self._halves is None:
+            half = len(self.ints) // 2
+            self._halves = (self.pool.intern(self.ints[:half]), self.pool.intern(self.ints[half:]))
+        return self._halves
+
+    @property
+    def coefficients(self):
+        """
+        Constants of the selection constraints for 1 and 2 bit tables, see `TableCommand1bit`
+        and `TableCommand2bit`
+        """
+        if self._coefficients is None:
+            c = self.values
+            if len(c) == 2:
+                self._coefficients = (c[0], c[1] - c[0])
+            elif len(c) == 4:
+                self._coefficients = (c[1] - c[0], c[3] - c[2] - c[1] + c[0], -c[0], -c[2] + c[0])
+        return self._coefficients
+
+
+class LutPool(object):
+    __slots__ = ('tables', '_raw')
+
+    def __init__(self):
+        """
+        Interns lookup tables by their contents, so each unique table is converted
+        to field elements, and has its coefficients computed, only once
+        """
+        self.tables = dict()
+        self._raw = dict()
+
+    def intern(self, lut):
+        raw = tuple(lut)
+        table = self._raw.get(raw)
+        if table is None:
+            ints = tuple(int(_) % SNARK_SCALAR_FIELD for _ in raw)
+            table = self.tables.get(ints)
+            if table is None:
+                table = self.tables[ints] = LookupTable(ints, self)
+            self._raw[raw] = table
+        return table
+
+
 class InvalidCommandError(Exception):
     __slots__ = ('stmt', 'line')
 
@@ -23,12 +124,14 @@ class InvalidCommandError(Exception):
 
 
 class AbstractCommand(object):
-    __slots__ = ('inputs', 'outputs', 'aux')
+    __slots__ = ('inputs', 'outputs', 'aux', 'line_no')
 
     def __init__(self, inputs, outputs, aux=None):
         self.inputs = inputs
         self.outputs = outputs
         self.aux = aux
+        # Source line of the statement, if known
+        self.line_no = None
 
     def as_statement(self):
         raise NotImplementedError()
@@ -55,6 +158,15 @@ class AbstractCommand(object):
         assert isinstance(state, State)
         raise NotImplementedError()
 
+    def compile(self, state, tape):
+        """
+        Emits instructions to the tape which are equivalent to `evaluate`
+        Performed after setup
+        """
+        assert isinstance(state, State)
+        assert isinstance(tape, Tape)
+        raise NotImplementedError()
+
     def constraints(self, state):
         """
         Emits a list of R1CS constraints
@@ -106,6 +218,15 @@ class AbstractBinaryCommand(AbstractCommand):
         result = self.op(*vals)
         state.var_value_set(self.outputs[0], result)
 
+    def compile(self, state, tape):
+        opcodes = {
+            'and': OP_AND,
+            'xor': OP_XOR,
+            'or': OP_OR,
+        }
+        a, b = [tape.operand(state, _) for _ in self.inputs]
+        tape.emit(opcodes[self.term], tape.slot(state, self.outputs[0]), a, b)
+
 
 class XorBinaryCommand(AbstractBinaryCommand):
     """
@@ -116,10 +237,10 @@ class XorBinaryCommand(AbstractBinaryCommand):
         return 'xor'
 
     def constraints(self, state):
-        a = state[self.inputs[0]] * 2
+        a = state[self.inputs[0]]
         b = state[self.inputs[1]]
         c = a + b - state[self.outputs[0]]
-        return [Constraint(a, b, c)]
+        return [Constraint(a * 2, b, c)]
 
 
 class AndBinaryCommand(AbstractBinaryCommand):
@@ -176,17 +297,20 @@ class AddCommand(AbstractCommand):
         # Evaluation unnecessary, everything is linear constraints
         pass
 
+    def compile(self, state, tape):
+        # Linear combinations are materialised by their consumers
+        pass
+
     def constraints(self, state):
         # Evaluation unnecessary, everything is linear constraints
-        pass
+        return []
 
 
 class SubCommand(AddCommand):
     def as_statement(self):
         return GenericStatement('sub', self.inputs, self.outputs)
 
-    @property
-    def lc_result(self):
+    def lc_result(self, state):
         return reduce(operator.sub, [state[_] for _ in self.inputs])
 
 
@@ -231,6 +355,10 @@ class ConstMulCommand(AbstractCommand):
         # Evaluation unnecessary, everything is linear constraints        
         pass
 
+    def compile(self, state, tape):
+        # Linear combinations are materialised by their consumers
+        pass
+
     def constraints(self, state):
         # Evaluation unnecessary, everything is linear constraints
         return []
@@ -268,6 +396,10 @@ class NonZeroCheckCommand(AbstractCommand):
         # Intermediate value 'M'
         state.var_value_set(self.outputs[0], 1/input_val)
 
+    def compile(self, state, tape):
+        M, Y = [tape.slot(state, _) for _ in self.outputs]
+        tape.emit(OP_ZEROP, tape.operand(state, self.inputs[0]), M, Y)
+
     def constraints(self, state):
         """
         Disjunction gadget
@@ -302,6 +434,10 @@ class AssertCommand(AbstractCommand):
 
         return cls(stmt.in_vars, stmt.out_vars)
 
+    def setup(self, state):
+        # Only constrains existing variables
+        pass
+
     def evaluate(self, state):
         a = state.value(self.inputs[0])
         b = state.value(self.inputs[1])
@@ -310,8 +446,13 @@ class AssertCommand(AbstractCommand):
         if (a * b) != c:
             raise RuntimeError("Assertion failed!")
 
+    def compile(self, state, tape):
+        a, b = [tape.operand(state, _) for _ in self.inputs]
+        tape.emit(OP_ASSERT, a, b, tape.operand(state, self.outputs[0]))
+
     def constraints(self, state):
-        return [Constraint(self.inputs[0], self.inputs[1], self.outputs[0])]
+        a, b = [state[_] for _ in self.inputs]
+        return [Constraint(a, b, state[self.outputs[0]])]
 
 
 class PackCommand(AbstractCommand):
@@ -336,17 +477,23 @@ class PackCommand(AbstractCommand):
         state.var_new(self.outputs[0])
 
     def evaluate(self, state):
-        result = self.lc_result(state).evaluate(state)
-        state.var_value_set(self.outputs[0], result)
+        result = 0
+        for i, idx in enumerate(self.inputs):
+            result += int(state.value(idx)) << i
+        state.var_value_set(self.outputs[0], FQ(result))
+
+    def compile(self, state, tape):
+        slots = tuple(tape.operand(state, _) for _ in self.inputs)
+        powers = tuple(powers_of_two(len(slots)))
+        tape.emit(OP_LC, tape.slot(state, self.outputs[0]), slots, powers)
 
     def lc_result(self, state):
-        powers = [2**_ for _ in range(len(self.inputs))]
-        terms = [self.state[idx] * p
-                 for idx, p in zip(self.inputs, powers)]
-        return Combination(*terms)
+        terms = [state[idx] * p
+                 for idx, p in zip(self.inputs, powers_of_two(len(self.inputs)))]
+        return Combination.coerce(reduce(operator.add, terms))
 
     def constraints(self, state):
-        return [Constraint(self.lc_result(state), 1, self.outputs[0])]
+        return [Constraint(self.lc_result(state), state.ONE, state[self.outputs[0]])]
 
 
 class SplitCommand(AbstractCommand):
@@ -372,11 +519,25 @@ class SplitCommand(AbstractCommand):
             state.var_new(idx)
 
     def evaluate(self, state):
-        value = state.value(self.inputs[0])
-        for i in range(len(self.outputs)):
-            bit_value = value & (2**i)
-            out_val = 1 if bit_value != 0 else 0
-            state.var_value_set(self.outputs[i], out_val)
+        # Little-endian binary string of the value, bits beyond its length are zero
+        value = int(state.value(self.inputs[0]))
+        bits = bin(value)[:1:-1].ljust(len(self.outputs), '0')
+        state.var_values_update(zip(self.outputs, map(BIT_VALUES.__getitem__, bits)))
+
+    def compile(self, state, tape):
+        outputs = tuple(tape.slot(state, _) for _ in self.outputs)
+        tape.emit(OP_SPLIT, tape.operand(state, self.inputs[0]), outputs)
+
+    def constraints(self, state):
+        """
+        Each output is constrained to be a bit, and the input must be
+        equal to the sum of the bits multiplied by their powers of two
+        """
+        bits = [state[_] for _ in self.outputs]
+        result = [Constraint(b, b, b) for b in bits]
+        packed = Combination(*[Term(b, p) for b, p in zip(bits, powers_of_two(len(bits)))])
+        result.append(Constraint(packed, state.ONE, state[self.inputs[0]]))
+        return result
 
 
 class MulCommand(AbstractCommand):
@@ -407,12 +568,20 @@ class MulCommand(AbstractCommand):
         state.var_new(self.outputs[0])
 
     def evaluate(self, state):
-        product = state.value(state[self.inputs[0]])
+        product = state.value(self.inputs[0])
         outputs = self.aux + self.outputs
         for i, idx in enumerate(self.inputs[1:]):
             product = product * state.value(idx)
             state.var_value_set(outputs[i], product)
 
+    def compile(self, state, tape):
+        outputs = self.aux + self.outputs
+        a = tape.operand(state, self.inputs[0])
+        for i, idx in enumerate(self.inputs[1:]):
+            dst = tape.slot(state, outputs[i])
+            tape.emit(OP_MUL, dst, a, tape.operand(state, idx))
+            a = dst
+
     def constraints(self, state):
         # [a b c d]
         #   a * b = x
@@ -425,7 +594,7 @@ class MulCommand(AbstractCommand):
         for i, b in enumerate(it):
             b = state[b]
             out = state[outputs[i]]
-            result.append(Constraint(Term(a), Term(b), Term(out)))
+            result.append(Constraint(a, b, out))
             a = state[outputs[i]]
         return result
 
@@ -448,7 +617,7 @@ class TableCommand(AbstractCommand):
             raise InvalidCommandError('Unsupported table with %d bits' % (n_bits,), stmt, line)
 
     @classmethod
-    def from_statement(cls, stmt, line):
+    def from_statement(cls, stmt, line, luts=None):
         if not isinstance(stmt, TableStatement):
             raise InvalidCommandError('Must be TableStatement', stmt, line)
 
@@ -458,14 +627,16 @@ class TableCommand(AbstractCommand):
         # Require 2^n LUT entries, where each input is binary
         lut_n_expected = (2**len(stmt.in_vars))
         if len(stmt.lut) != lut_n_expected:
-            raise InvalidCommandError("Lookup table count mismatch, expected %d, got %d" % (lut_n_expected, len(lut)), stmt, line)
+            raise InvalidCommandError("Lookup table count mismatch, expected %d, got %d" % (lut_n_expected, len(stmt.lut)), stmt, line)
 
         sub_cls = cls.cls_for_n_inputs(len(stmt.in_vars), stmt, line)
 
-        lut = [FQ(int(_)) for _ in stmt.lut]
-        return sub_cls(lut, stmt.in_vars, stmt.out_vars)
+        if luts is None:
+            luts = LutPool()
+        return sub_cls(luts.intern(stmt.lut), stmt.in_vars, stmt.out_vars)
 
     def __init__(self, lut, in_vars, out_vars):
+        assert isinstance(lut, LookupTable)
         self.lut = lut
         super(TableCommand, self).__init__(in_vars, out_vars)
 
@@ -473,16 +644,13 @@ class TableCommand(AbstractCommand):
         state.var_new(self.outputs[0])
 
     def evaluate(self, state):
-        idx = 0
-        for i, var_idx in enumerate(self.inputs):
-            value = int(state.value(var_idx))
-            if value not in [0, 1]:
-                raise RuntimeError("Variable %d expected to be binary" % (var_idx,))
-            idx += ((2**i) * value)
-        assert idx < len(self.lut)
-        result = self.lut[idx]
+        result = self.lut[table_index(state, self.inputs)]
         state.var_value_set(self.outputs[0], result)
 
+    def compile(self, state, tape):
+        inputs = tuple(tape.operand(state, _) for _ in self.inputs)
+        tape.emit(OP_TABLE, tape.slot(state, self.outputs[0]), inputs, self.lut.ints)
+
 
 class TableCommand1bit(TableCommand):
     def constraints(self, state):
@@ -491,26 +659,24 @@ class TableCommand1bit(TableCommand):
         r = state[self.outputs[0]] # result
 
         # Linear combination to select from lookup table
-        a = state.constant(self.lut[0])
-        a += (b*self.lut[1])
-        a -= (b*self.lut[0])
+        # a = c[0] + (b * (c[1] - c[0]))
+        c_0, c_bit = self.lut.coefficients
+        a = state.constant(c_0) + (b * c_bit)
 
         return [Constraint(a, one, r)]
 
 
 class TableCommand2bit(TableCommand):
     def constraints(self, state):
-        c = self.lut
+        lhs_c, lhs_c_bit, rhs_c, rhs_c_bit = self.lut.coefficients
         b = [state[_] for _ in self.inputs]
         r = state[self.outputs[0]]
 
         # lhs = c[1] - c[0] + (b[1] * (c[3] - c[2] - c[1] + c[0]))
-        lhs_bit = b[1] * (c[3] - c[2] - c[1] + c[0])
-        lhs = state.constant(c[1] - c[0]) + lhs_bit
+        lhs = state.constant(lhs_c) + (b[1] * lhs_c_bit)
 
         # rhs = -c[0] + r + (b[1] * (-c[2] + c[0]))
-        rhs_bit = b[1] * (-c[2] + c[0])
-        rhs = state.constant(-c[0]) + r + rhs_bit
+        rhs = state.constant(rhs_c) + r + (b[1] * rhs_c_bit)
 
         return [Constraint(lhs, b[0], rhs)]
 
@@ -518,6 +684,7 @@ class TableCommand2bit(TableCommand):
 class TableCommandNbit(AbstractCommand):
     __slots__ = ('lut', 'mux_a', 'mux_b')
     def __init__(self, lut, in_vars, out_vars):
+        assert isinstance(lut, LookupTable)
         super(TableCommandNbit, self).__init__(in_vars, out_vars)
         self.lut = lut
 
@@ -527,33 +694,64 @@ class TableCommandNbit(AbstractCommand):
     def setup(self, state):
         self.aux = []
 
-        half = len(self.lut) // 2
-        assert (len(self.lut) % half) == 0
+        lut_a, lut_b = self.lut.halves()
 
         # This allows for recursive construction for any number of inputs
         sub_cls = TableCommand.cls_for_n_inputs(len(self.inputs) - 1)
 
         self.aux.append(state.var_new()) # aux 0
-        self.mux_a = sub_cls(self.lut[:half], self.inputs[:-1], [self.aux[-1]])
+        self.mux_a = sub_cls(lut_a, self.inputs[:-1], [self.aux[-1]])
 
         self.aux.append(state.var_new()) # aux 1
-        self.mux_b = sub_cls(self.lut[half:], self.inputs[:-1], [self.aux[-1]])
+        self.mux_b = sub_cls(lut_b, self.inputs[:-1], [self.aux[-1]])
 
         self.aux.append(state.var_new()) # aux 2
         self.aux.append(state.var_new()) # aux 3
 
-        state.lc_create(self.aux[2] + self.aux[3], self.outputs[0])
+        # Nested tables have their own auxilliary variables, which follow ours
+        for mux in (self.mux_a, self.mux_b):
+            if isinstance(mux, TableCommandNbit):
+                mux.setup(state)
+                self.aux += mux.aux
 
-    def evaluate(self, state):
-        self.mux_a.evaluate(state)
-        aux_0 = state.value(self.aux[0])
+        # When nested the output is a variable of the parent table, rather than a linear combination
+        if not isinstance(self.outputs[0], Variable):
+            state.lc_create(self.aux[2] + self.aux[3], self.outputs[0])
 
-        self.mux_b.evaluate(state)
-        aux_1 = state.value(self.aux[1])
+    def evaluate(self, state):
+        # Index the table once, then derive every auxiliary value of the mux tree from it
+        items = []
+        self.aux_values(table_index(state, self.inputs), items)
+        state.var_values_update(items)
 
-        b = state.value(self.inputs[-1])
-        state.var_value_set(self.aux[2], ((1-b)*aux_0))
-        state.var_value_set(self.aux[3], (b*aux_1))
+    def aux_values(self, idx, items):
+        """
+        Appends the values of the auxiliary variables for the table index,
+        including those of nested sub-tables, as (idx, value) pairs to `items`
+        """
+        half = len(self.lut) // 2
+        low = idx % half
+        for mux in (self.mux_a, self.mux_b):
+            if isinstance(mux, TableCommandNbit):
+                mux.aux_values(low, items)
+        # The sub-tables output into aux 0 and aux 1, their results are entries of this table
+        aux_0 = self.lut[low]
+        aux_1 = self.lut[half + low]
+        if idx < half:
+            aux_2, aux_3 = aux_0, BIT_VALUES['0']
+        else:
+            aux_2, aux_3 = BIT_VALUES['0'], aux_1
+        items += [(self.aux[0].idx, aux_0), (self.aux[1].idx, aux_1),
+                  (self.aux[2].idx, aux_2), (self.aux[3].idx, aux_3)]
+
+    def compile(self, state, tape):
+        self.mux_a.compile(state, tape)
+        self.mux_b.compile(state, tape)
+        aux = [tape.slot(state, _) for _ in self.aux[:4]]
+        sel = tape.operand(state, self.inputs[-1])
+        tape.emit(OP_MUX, aux[2], aux[3], aux[0], aux[1], sel)
+        if isinstance(self.outputs[0], Variable):
+            tape.emit(OP_LC, tape.slot(state, self.outputs[0]), (aux[2], aux[3]), (1, 1))
 
     def constraints(self, state):
         ret = list()
@@ -562,11 +760,13 @@ class TableCommandNbit(AbstractCommand):
 
         # Then selector to choose the first or second auxilliary output depending on the third bit
         b = state[self.inputs[-1]]
-        aux = [state[_] for _ in self.aux]
+        aux = [state[_] for _ in self.aux[:4]]
         ret += [
             Constraint(aux[0], state.ONE - b, aux[2]),
             Constraint(aux[1], b, aux[3]),
         ]
+        if isinstance(self.outputs[0], Variable):
+            ret.append(Constraint(aux[2] + aux[3], state.ONE, state[self.outputs[0]]))
 
         return ret
 
@@ -595,15 +795,20 @@ COMMANDS = {
 }
 
 
-def make_command(stmt, line=None):
+def make_command(stmt, line=None, luts=None):
+    """
+    Lookup tables are interned in the `LutPool` given as `luts`, if any
+    """
     if not isinstance(stmt, AbstractStatement):
         raise InvalidCommandError("Must be AbstractStatement", stmt, line)
     if isinstance(stmt, TableStatement):
-        term = 'table'
+        cmd = TableCommand.from_statement(stmt, line, luts)
     elif isinstance(stmt, GenericStatement):
-        term = stmt.term
+        if stmt.term not in COMMANDS:
+            raise InvalidCommandError("Unknown term %r" % (stmt.term,), stmt, line)
+        cmd = COMMANDS[stmt.term].from_statement(stmt, line)
     else:
         raise InvalidCommandError("Unknown statement type: %r" % (type(stmt),), stmt, line)
-    if term not in COMMANDS:
-        raise InvalidCommandError("Unknown term %r" % (term,), stmt, line)
-    return COMMANDS[term].from_statement(stmt, line)
+    if line is not None:
+        cmd.line_no = line.line_no
+    return cmd
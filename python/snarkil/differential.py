@@ -0,0 +1,302 @@
+from __future__ import print_function
+import io
+import os
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import subprocess
+
+from .program import Program
+
+
+# Matches the values displayed for each instruction by `il-pinocchio trace`
+TRACE_VALUE = re.compile(r'^\s+(?:in|out) (\d+) = (\d+)\s*$')
+
+# Width of the values assigned to inputs which may be split
+NARROW_BITS = 64
+
+
+class RandomCircuit(object):
+	__slots__ = ('rand', 'lines', 'values', 'fields', 'bits', 'zeros', 'narrow', 'total')
+
+	def __init__(self, seed):
+		"""
+		Builds a random circuit which uses every opcode understood by both the
+		Python and C++ evaluators, and values for its inputs.
+
+		Wires are tracked by kind, so each command is given valid inputs: the
+		boolean operations and tables are only given bits, splits are only given
+		values known to fit in their outputs, and asserts are only given the
+		inputs and result of an earlier multiplication. Wires known to be zero
+		are also tracked, so the handling of zero by `zerop` is compared too.
+		"""
+		self.rand = random.Random(seed)
+		self.lines = []
+		self.values = dict()
+		self.fields = []
+		self.bits = []
+		self.zeros = []
+		self.narrow = dict()
+		self.total = 0
+
+	def wire(self):
+		self.total += 1
+		return self.total - 1
+
+	def input(self, value, kind):
+		idx = self.wire()
+		self.lines.append("input %d" % (idx,))
+		self.values[idx] = value
+		kind.append(idx)
+		return idx
+
+	def emit(self, term, inputs, outputs):
+		self.lines.append("%s in %d <%s> out %d <%s>" % (
+			term, len(inputs), ' '.join(str(_) for _ in inputs),
+			len(outputs), ' '.join(str(_) for _ in outputs)))
+
+	def gen_add(self):
+		inputs = self.rand.sample(self.fields, self.rand.randint(2, min(4, len(self.fields))))
+		self.emit('add', inputs, [self.wire()])
+		self.fields.append(self.total - 1)
+
+	def gen_mul(self):
+		a, b = self.rand.sample(self.fields, 2)
+		out = self.wire()
+		self.emit('mul', [a, b], [out])
+		self.fields.append(out)
+		if self.rand.random() < 0.5:
+			self.emit('assert', [a, b], [out])
+
+	def gen_bit_mul(self):
+		a, b = self.rand.sample(self.bits, 2)
+		self.emit('mul', [a, b], [self.wire()])
+		self.bits.append(self.total - 1)
+
+	def gen_const_mul(self):
+		term = self.rand.choice(['const-mul', 'const-mul-neg'])
+		constant = self.rand.getrandbits(self.rand.choice([8, 64, 253]))
+		self.emit('%s-%x' % (term, constant), [self.rand.choice(self.fields)], [self.wire()])
+		self.fields.append(self.total - 1)
+		if constant == 0:
+			self.zeros.append(self.total - 1)
+
+	def gen_zero(self):
+		self.emit('const-mul-0', [self.rand.choice(self.fields)], [self.wire()])
+		self.fields.append(self.total - 1)
+		self.zeros.append(self.total - 1)
+
+	def gen_binary(self):
+		term = self.rand.choice(['xor', 'or'])
+		self.emit(term, self.rand.sample(self.bits, 2), [self.wire()])
+		self.bits.append(self.total - 1)
+
+	def gen_zerop(self):
+		# Usually a random field element, sometimes a wire known to be zero
+		if self.zeros and self.rand.random() < 0.25:
+			idx = self.rand.choice(self.zeros)
+		else:
+			idx = self.rand.choice(self.fields)
+		inverse, nonzero = self.wire(), self.wire()
+		self.emit('zerop', [idx], [inverse, nonzero])
+		self.fields.append(inverse)
+		self.bits.append(nonzero)
+
+	def gen_split(self):
+		idx = self.rand.choice(sorted(self.narrow))
+		n_bits = self.narrow[idx] + self.rand.randint(0, 2)
+		outputs = [self.wire() for _ in range(n_bits)]
+		self.emit('split', [idx], outputs)
+		self.bits += outputs
+
+	def gen_pack(self):
+		inputs = [self.rand.choice(self.bits) for _ in range(self.rand.randint(2, 32))]
+		out = self.wire()
+		self.emit('pack', inputs, [out])
+		self.fields.append(out)
+		self.narrow[out] = len(inputs)
+
+	def gen_table(self):
+		n_inputs = self.rand.randint(1, 4)
+		lut = [self.rand.getrandbits(64) for _ in range(2**n_inputs)]
+		out = self.wire()
+		self.lines.append("table %d <%s> in <%s> out <%d>" % (
+			len(lut), ' '.join(str(_) for _ in lut),
+			' '.join(str(_) for _ in self.rand.sample(self.bits, n_inputs)), out))
+		self.fields.append(out)
+
+	def generate(self, n_commands, n_inputs=8):
+		rand = self.rand
+		for _ in range(n_inputs):
+			self.input(rand.getrandbits(253), self.fields)
+			self.input(rand.getrandbits(1), self.bits)
+			idx = self.input(rand.getrandbits(NARROW_BITS), self.fields)
+			self.narrow[idx] = NARROW_BITS
+		generators = [self.gen_add, self.gen_mul, self.gen_bit_mul, self.gen_const_mul, self.gen_zero,
+					  self.gen_binary, self.gen_zerop, self.gen_split, self.gen_pack, self.gen_table]
+		for _ in range(n_commands):
+			rand.choice(generators)()
+		outputs = rand.sample(range(self.total), min(8, self.total))
+		self.lines += ["output %d" % (_,) for _ in sorted(outputs)]
+		return self
+
+	def circuit(self):
+		return "total %d\n%s\n" % (self.total, '\n'.join(self.lines))
+
+	def inputs(self):
+		# Without a prefix, both evaluators read input values as hexadecimal
+		return ''.join("%d=%x\n" % (idx, value) for idx, value in sorted(self.values.items()))
+
+
+def python_values(circuit_path, input_path, wires, compact=False, compile=False):
+	"""
+	Value of every wire after evaluating the circuit with the Python implementation
+	"""
+	program = Program.from_file(circuit_path, compact)
+	program.setup()
+	if compile:
+		program.compile()
+	with open(input_path, 'r') as handle:
+		program.set_values(Program.parse_inputs(handle))
+	program.run()
+	return {idx: int(program.value(str(idx))) for idx in wires}
+
+
+def cxx_values(cli, circuit_path, input_path, wires=None):
+	"""
+	Value of every wire read or written by an instruction, from the trace of the C++ implementation
+	"""
+	output = subprocess.check_output([cli, circuit_path, 'trace', input_path], universal_newlines=True)
+	result = dict()
+	for line in output.splitlines():
+		match = TRACE_VALUE.match(line)
+		if match:
+			result[int(match.group(1))] = int(match.group(2))
+	return result
+
+
+def compare(expected, actual):
+	"""
+	Wires whose values differ, with the expected and actual values. Wires
+	which are missing from either are ignored.
+	"""
+	return sorted((idx, value, actual[idx]) for idx, value in expected.items()
+				  if idx in actual and actual[idx] != value)
+
+
+def timed_process(args, repeat):
+	"""
+	Best wall time of `repeat` runs of the command, including the process startup
+	"""
+	best = None
+	for _ in range(repeat):
+		begin = time.perf_counter()
+		subprocess.check_call(args, stdout=subprocess.DEVNULL)
+		elapsed = time.perf_counter() - begin
+		best = elapsed if best is None else min(best, elapsed)
+	return best
+
+
+ENGINES = {
+	'python': lambda cli, c, i, w: python_values(c, i, w),
+	'python-tape': lambda cli, c, i, w: python_values(c, i, w, compile=True),
+	'python-compact': lambda cli, c, i, w: python_values(c, i, w, compact=True),
+	'python-compact-tape': lambda cli, c, i, w: python_values(c, i, w, compact=True, compile=True),
+	'cxx': cxx_values,
+}
+
+
+def check(seed, size, engines, cli, directory, repeat):
+	"""
+	Generate a random circuit, evaluate it with every engine, then compare
+	each against the first. Returns a dictionary of the mismatches and timings.
+	"""
+	generated = RandomCircuit(seed).generate(size)
+	circuit_path = os.path.join(directory, 'random-%d.circuit' % (seed,))
+	input_path = os.path.join(directory, 'random-%d.input' % (seed,))
+	with io.open(circuit_path, 'w') as handle:
+		handle.write(generated.circuit())
+	with io.open(input_path, 'w') as handle:
+		handle.write(generated.inputs())
+
+	reference = None
+	result = {'seed': seed, 'size': size, 'wires': generated.total, 'mismatches': {}, 'seconds': {}}
+	for name in engines:
+		values = ENGINES[name](cli, circuit_path, input_path, range(generated.total))
+		if reference is None:
+			reference = values
+		else:
+			result['mismatches'][name] = compare(reference, values)
+	if repeat:
+		python = [sys.executable, '-m', 'snarkil.program', circuit_path, input_path]
+		result['seconds']['python'] = timed_process(python, repeat)
+		result['seconds']['python-tape'] = timed_process(python[:3] + ['--compile'] + python[3:], repeat)
+		if 'cxx' in engines:
+			result['seconds']['cxx'] = timed_process([cli, circuit_path, 'eval', input_path], repeat)
+	return result
+
+
+def report(result, handle=sys.stdout):
+	status = 'ok'
+	if any(result['mismatches'].values()):
+		status = 'MISMATCH'
+	timings = ' '.join("%s=%.3fs" % _ for _ in sorted(result['seconds'].items()))
+	print("seed=%-6d size=%-6d wires=%-7d %-8s %s" % (
+		  result['seed'], result['size'], result['wires'], status, timings), file=handle)
+	for name, mismatches in sorted(result['mismatches'].items()):
+		for idx, expected, actual in mismatches[:5]:
+			print("\t%s: wire %d is %d, expected %d" % (name, idx, actual, expected), file=handle)
+		if len(mismatches) > 5:
+			print("\t%s: %d more wires differ" % (name, len(mismatches) - 5), file=handle)
+
+
+def differential_main(argv):
+	parser = argparse.ArgumentParser(prog=argv[0], description="Compare the Python and C++ evaluators on random circuits")
+	parser.add_argument('--cli', metavar='PATH', default='.build/il-pinocchio',
+						help="The C++ il-pinocchio executable")
+	parser.add_argument('--python-only', action='store_true',
+						help="Only compare the Python evaluators with each other")
+	parser.add_argument('--seed', metavar='N', type=int, default=0, help="Seed of the first circuit")
+	parser.add_argument('--count', metavar='N', type=int, default=20, help="Number of circuits to generate")
+	parser.add_argument('--size', metavar='N', type=int, default=200, help="Number of commands in each circuit")
+	parser.add_argument('--repeat', metavar='N', type=int, default=0,
+						help="Time each evaluator as a separate process, reporting the best of N runs")
+	parser.add_argument('--keep', metavar='DIR',
+						help="Write the circuits and inputs to the directory, rather than a temporary one")
+	parser.add_argument('--output', metavar='FILE', help="Write the results as JSON to the file")
+	args = parser.parse_args(argv[1:])
+
+	engines = sorted(ENGINES, key=lambda _: (_ != 'python', _))
+	if args.python_only:
+		engines.remove('cxx')
+	elif not os.access(args.cli, os.X_OK):
+		print("Error: cannot execute %r, build it with 'make' or use --python-only" % (args.cli,), file=sys.stderr)
+		return 1
+
+	results = []
+	with tempfile.TemporaryDirectory() as directory:
+		if args.keep:
+			os.makedirs(args.keep, exist_ok=True)
+			directory = args.keep
+		for seed in range(args.seed, args.seed + args.count):
+			result = check(seed, args.size, engines, args.cli, directory, args.repeat)
+			report(result)
+			results.append(result)
+
+	if args.output:
+		with open(args.output, 'w') as handle:
+			json.dump({'engines': engines, 'results': results}, handle, indent=2, sort_keys=True)
+
+	failed = [_['seed'] for _ in results if any(_['mismatches'].values())]
+	if failed:
+		print("Error: %d of %d circuits differ, seeds %r" % (len(failed), len(results), failed), file=sys.stderr)
+		return 2
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(differential_main(sys.argv))
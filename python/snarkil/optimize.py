@@ -0,0 +1,260 @@
+from __future__ import print_function
+import sys
+import operator
+from copy import deepcopy
+from functools import reduce
+
+from ethsnarks.field import SNARK_SCALAR_FIELD
+
+from .commands import AbstractBinaryCommand, AddCommand, SubCommand, AssertCommand, ConstMulCommand, MulCommand, \
+	NonZeroCheckCommand, PackCommand, SplitCommand, TableCommand, TableCommandNbit
+
+
+P = SNARK_SCALAR_FIELD
+
+# Terms where the order of the inputs doesn't affect the outputs
+COMMUTATIVE = frozenset(['add', 'mul', 'xor', 'and', 'or'])
+
+
+def command_key(cmd):
+	"""
+	Key which is equal for any two commands that compute the same outputs
+	"""
+	term = cmd.as_statement().term
+	inputs = cmd.inputs
+	if term in COMMUTATIVE:
+		inputs = sorted(inputs, key=str)
+	if isinstance(cmd, ConstMulCommand):
+		return ('const-mul', cmd.value % P, tuple(inputs))
+	if isinstance(cmd, (TableCommand, TableCommandNbit)):
+		return (term, cmd.lut.ints, tuple(inputs))
+	if isinstance(cmd, AssertCommand):
+		# The output of an assert is read, not written
+		return (term, tuple(inputs), tuple(cmd.outputs))
+	# A split into fewer bits also constrains the range of its input
+	return (term, tuple(inputs), len(cmd.outputs))
+
+
+def literal(one, wire, value):
+	"""
+	Command which assigns a constant to the wire, as a multiple of `ONE`
+	"""
+	return ConstMulCommand([one], [wire], value % P, False)
+
+
+def fold_binary(cmd, values, one):
+	a, b = values
+	if a is not None and b is not None:
+		if a in (0, 1) and b in (0, 1):
+			return [literal(one, cmd.outputs[0], cmd.op(a, b))]
+		return None
+	if a is None:
+		known, other = b, cmd.inputs[0]
+	else:
+		known, other = a, cmd.inputs[1]
+	if known not in (0, 1):
+		return None
+	term = cmd.term
+	if (term == 'and' and known == 0) or (term == 'or' and known == 1):
+		return [literal(one, cmd.outputs[0], known)]
+	if term == 'xor' and known == 1:
+		return [SubCommand([one, other], cmd.outputs)]
+	return [ConstMulCommand([other], cmd.outputs, 1, False)]
+
+
+def fold_mul(cmd, values, one):
+	unknown = [idx for idx, value in zip(cmd.inputs, values) if value is None]
+	if len(unknown) == len(values):
+		return None
+	product = reduce(lambda a, b: (a * b) % P, [_ for _ in values if _ is not None], 1)
+	if not unknown or product == 0:
+		return [literal(one, cmd.outputs[0], product)]
+	if len(unknown) == 1:
+		return [ConstMulCommand(unknown, cmd.outputs, product, False)]
+	if product == 1:
+		return [MulCommand(unknown, cmd.outputs)]
+	return None
+
+
+def fold_table(cmd, values, one):
+	if any(_ not in (None, 0, 1) for _ in values):
+		return None
+	unknown = [i for i, value in enumerate(values) if value is None]
+	if len(unknown) == len(values):
+		return None
+	base = sum(value << i for i, value in enumerate(values) if value is not None)
+	lut = []
+	for j in range(2**len(unknown)):
+		idx = base + sum(((j >> k) & 1) << i for k, i in enumerate(unknown))
+		lut.append(cmd.lut.ints[idx])
+	if not unknown:
+		return [literal(one, cmd.outputs[0], lut[0])]
+	sub_cls = TableCommand.cls_for_n_inputs(len(unknown))
+	return [sub_cls(cmd.lut.pool.intern(lut), [cmd.inputs[_] for _ in unknown], cmd.outputs)]
+
+
+def fold_command(cmd, values, one):
+	"""
+	Returns the commands which replace `cmd` given the constant values of
+	its inputs, where `None` is an unknown value, or None if it can't be folded.
+	"""
+	if isinstance(cmd, (TableCommand, TableCommandNbit)):
+		return fold_table(cmd, values, one)
+	if isinstance(cmd, AbstractBinaryCommand):
+		return fold_binary(cmd, values, one)
+	if isinstance(cmd, MulCommand):
+		return fold_mul(cmd, values, one)
+	if isinstance(cmd, AssertCommand):
+		if None not in values and (values[0] * values[1] - values[2]) % P == 0:
+			return []
+		return None
+	if isinstance(cmd, ConstMulCommand) and cmd.value % P == 0:
+		# Zero whatever the input
+		return [literal(one, cmd.outputs[0], 0)]
+	if None in values:
+		return None
+	if isinstance(cmd, ConstMulCommand):
+		return [literal(one, cmd.outputs[0], values[0] * cmd.value)]
+	if isinstance(cmd, AddCommand):
+		op = operator.sub if isinstance(cmd, SubCommand) else operator.add
+		return [literal(one, cmd.outputs[0], reduce(op, values))]
+	if isinstance(cmd, PackCommand):
+		return [literal(one, cmd.outputs[0], sum(value << i for i, value in enumerate(values)))]
+	if isinstance(cmd, NonZeroCheckCommand):
+		value = values[0]
+		inverse = pow(value, P - 2, P) if value else 0
+		M, Y = cmd.outputs
+		return [literal(one, M, inverse), literal(one, Y, 1 if value else 0)]
+	if isinstance(cmd, SplitCommand):
+		value = values[0]
+		if value >> len(cmd.outputs):
+			# Doesn't fit, the split must remain to be unsatisfiable
+			return None
+		return [literal(one, wire, (value >> i) & 1) for i, wire in enumerate(cmd.outputs)]
+	return None
+
+
+def fold_constants(commands, one, one_wire=None):
+	"""
+	Propagate constants through the commands, starting from the `one` variable
+	of the state, replacing commands whose results are known with multiples of
+	`one`, and simplifying those where only some inputs are known.
+
+	References to `one_wire`, an input which is always 1 (the 'one-input' of
+	jsnark circuits), are replaced with `one`.
+	"""
+	known = {one: 1}
+	result = []
+	for cmd in commands:
+		if one_wire is not None:
+			cmd.inputs = [one if _ == one_wire else _ for _ in cmd.inputs]
+			if isinstance(cmd, AssertCommand):
+				cmd.outputs = [one if _ == one_wire else _ for _ in cmd.outputs]
+		wires = cmd.inputs + cmd.outputs if isinstance(cmd, AssertCommand) else cmd.inputs
+		replacement = fold_command(cmd, [known.get(_) for _ in wires], one)
+		if replacement is None:
+			replacement = [cmd]
+		for new_cmd in replacement:
+			new_cmd.line_no = cmd.line_no
+			if isinstance(new_cmd, ConstMulCommand) and new_cmd.inputs[0] in known:
+				known[new_cmd.outputs[0]] = (known[new_cmd.inputs[0]] * new_cmd.value) % P
+		result += replacement
+	return result
+
+
+def merge_common(commands, outputs):
+	"""
+	Remove commands which are identical to an earlier command, the wires
+	written by a removed command are replaced by those of the earlier one
+	in every subsequent command. Commands which write to any of the program
+	`outputs` are never removed, as the output must keep its wire ID.
+	"""
+	seen = dict()
+	alias = dict()
+	result = []
+	for cmd in commands:
+		if alias:
+			cmd.inputs = [alias.get(_, _) for _ in cmd.inputs]
+			if isinstance(cmd, AssertCommand):
+				cmd.outputs = [alias.get(_, _) for _ in cmd.outputs]
+		key = command_key(cmd)
+		original = seen.get(key)
+		if original is None:
+			seen[key] = cmd
+		elif isinstance(cmd, AssertCommand):
+			continue
+		elif not any(_ in outputs for _ in cmd.outputs):
+			alias.update(zip(cmd.outputs, original.outputs))
+			continue
+		result.append(cmd)
+	return result
+
+
+def eliminate_dead(commands, outputs):
+	"""
+	Remove commands which write only to wires that are never read by
+	another command, and aren't program `outputs`.
+
+	Asserts have no outputs, and splits constrain the range of their input,
+	so both are always kept.
+	"""
+	live = set(outputs)
+	result = []
+	for cmd in reversed(commands):
+		if isinstance(cmd, AssertCommand):
+			live.update(cmd.outputs)
+		elif not isinstance(cmd, SplitCommand) and not any(_ in live for _ in cmd.outputs):
+			continue
+		live.update(cmd.inputs)
+		result.append(cmd)
+	result.reverse()
+	return result
+
+
+class OptimizeStats(object):
+	__slots__ = ('commands', 'constraints', 'variables')
+
+	def __init__(self):
+		"""
+		Constraint and variable counts of the program before and after optimising
+		"""
+		self.commands = []
+		self.constraints = []
+		self.variables = []
+
+	def measure(self, program):
+		"""
+		Count the constraints and variables of the program, which must not have
+		been setup yet. A copy of its state is used, so the program is unmodified.
+		"""
+		state = deepcopy(program.state)
+		for cmd in program.commands:
+			cmd.setup(state)
+		self.commands.append(len(program.commands))
+		self.constraints.append(sum(len(cmd.constraints(state)) for cmd in program.commands))
+		self.variables.append(sum(1 for _ in state.variables()))
+
+	def report(self, handle=sys.stderr):
+		for name in self.__slots__:
+			before, after = getattr(self, name)
+			print("# %s: %d -> %d (%+d)" % (name, before, after, after - before), file=handle)
+
+
+def optimize(program, stats=None, one_wire=None):
+	"""
+	Fold constants, merge common subexpressions, then remove dead commands from
+	the program, this must be performed before setup. When `stats` is given the
+	program is measured before and after.
+	"""
+	if stats is not None:
+		stats.measure(program)
+	state = program.state
+	if one_wire is not None:
+		one_wire = state.intern(one_wire)
+	outputs = set(state.intern(_) for _ in program.outputs)
+	commands = fold_constants(program.commands, state.ONE.idx, one_wire)
+	commands = merge_common(commands, outputs)
+	program.commands = eliminate_dead(commands, outputs)
+	if stats is not None:
+		stats.measure(program)
+	return program
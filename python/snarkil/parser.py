@@ -1,7 +1,9 @@
 from __future__ import print_function
 import re
 import sys
-from collections import namedtuple
+import time
+import argparse
+from collections import namedtuple, Counter
 
 
 class Line(object):
@@ -54,6 +56,7 @@ class AbstractStatement(object):
 
 class TableStatement(AbstractStatement):
     __slots__ = ('lut', 'in_vars', 'out_vars')
+    term = 'table'
 
     def __init__(self, lut, in_vars, out_vars):
         self.lut = lut
@@ -146,6 +149,7 @@ class ConstMulStatement(GenericStatement):
 
 class VariableCount(AbstractStatement):
     __slots__ = ('total',)
+    term = 'total'
 
     def __init__(self, total):
         self.total = total
@@ -212,7 +216,7 @@ def parse_vars(variable_ids, expected_count, name, line):
     return variable_ids
 
 
-COMMAND_RX = r'^\s*in\s+((?P<inn>[0-9]+)\s+)?<(?P<in>[^>]+)>\s+out\s+((?P<outn>[0-9]+)\s+)?<(?P<out>[^>]+)>\s*$'
+COMMAND_RX = re.compile(r'^\s*in\s+((?P<inn>[0-9]+)\s+)?<(?P<in>[^>]+)>\s+out\s+((?P<outn>[0-9]+)\s+)?<(?P<out>[^>]+)>\s*$')
 
 def parse_command(remainder, line):
     """
@@ -230,17 +234,18 @@ def parse_command(remainder, line):
     the variable indices.
     """
     assert isinstance(line, Line)
-    match = re.match(COMMAND_RX, remainder)
+    match = COMMAND_RX.match(remainder)
     if not match:
         raise ParseError('Cannot parse command', line)
 
-    in_vars = parse_vars(match.group('in'), match.group('inn'), 'in', line)
-    out_vars = parse_vars(match.group('out'), match.group('outn'), 'out', line)
+    inn, in_ids, outn, out_ids = match.group('inn', 'in', 'outn', 'out')
+    in_vars = parse_vars(in_ids, inn, 'in', line)
+    out_vars = parse_vars(out_ids, outn, 'out', line)
 
     return in_vars, out_vars
 
 
-TABLE_RX = r'^\s*((?P<lutn>[0-9]+)\s+)?<(?P<lut>[^>]+)>\s+in\s+((?P<inn>[0-9]+)\s+)?<(?P<in>[^>]+)>\s+out\s+((?P<outn>[0-9]+)\s+)?<(?P<out>[^>]+)>\s*$'
+TABLE_RX = re.compile(r'^\s*((?P<lutn>[0-9]+)\s+)?<(?P<lut>[^>]+)>\s+in\s+((?P<inn>[0-9]+)\s+)?<(?P<in>[^>]+)>\s+out\s+((?P<outn>[0-9]+)\s+)?<(?P<out>[^>]+)>\s*$')
 
 def parse_table(remainder, line):
     """
@@ -262,7 +267,7 @@ def parse_table(remainder, line):
 
     """
     assert isinstance(line, Line)
-    match = re.match(TABLE_RX, remainder)
+    match = TABLE_RX.match(remainder)
     if not match:
         raise ParseError('Cannot parse table', line)
 
@@ -273,8 +278,6 @@ def parse_table(remainder, line):
     return lut, in_vars, out_vars
 
 
-SPLIT_LINE_COMMENT_RX = r'^([^#]+)(#.*)?$'
-
 def line_iterator(handle):
     """
     Iterate through the lines
@@ -290,18 +293,14 @@ def line_iterator(handle):
             continue
 
         # Remove comment from end of line
-        m = re.match(SPLIT_LINE_COMMENT_RX, line)
-        if not m:
-            # Unable to match? Ignore line, it's probably empty
-            continue
+        line, sep, comment = line.partition('#')
+        comment = sep + comment if sep else None
 
         # Ignore empty lines (after processing)
-        line = m.group(1).strip()
+        line = line.strip()
         if not len(line):
             continue
 
-        comment = m.group(2)
-
         # Split and emit
         term, remainder = line.split(' ', 1)
         term = term.lower()
@@ -345,7 +344,10 @@ DEFAULT_COMMANDS = {
     'pack': GenericStatement,
 }
 
-def parse(handle, commands=None, replacements=None):
+def parse(handle, commands=None, replacements=None, lines=False):
+    """
+    Yields each statement, or `(statement, line)` pairs when `lines` is True
+    """
     if replacements is None:
         replacements = DEFAULT_REPLACEMENTS
 
@@ -364,14 +366,61 @@ def parse(handle, commands=None, replacements=None):
 
         # Pass `Line` object command, to allow for better error messages
         cmd_type = commands[line.term]
-        yield cmd_type.from_line(line)
+        if lines:
+            yield cmd_type.from_line(line), line
+        else:
+            yield cmd_type.from_line(line)
+
+
+class ParseStats(object):
+    __slots__ = ('lines', 'statements', 'wires', 'terms', 'started')
+
+    def __init__(self):
+        """
+        Consumes statements as they're parsed, retaining only counters
+        """
+        self.lines = 0
+        self.statements = 0
+        self.wires = 0
+        self.terms = Counter()
+        self.started = time.time()
+
+    def count_lines(self, handle):
+        """
+        Wraps a file handle, counting every line read from it
+        """
+        for raw_line in handle:
+            self.lines += 1
+            yield raw_line
+
+    def consume(self, stmt):
+        self.statements += 1
+        self.terms[stmt.term] += 1
+        if isinstance(stmt, (GenericStatement, TableStatement)):
+            self.wires += len(stmt.in_vars) + len(stmt.out_vars)
+
+    def report(self, handle=sys.stderr):
+        elapsed = max(time.time() - self.started, 1e-9)
+        for term, count in sorted(self.terms.items()):
+            print("%s %d" % (term, count), file=handle)
+        print("# %d lines, %d statements, %d wire references" % (self.lines, self.statements, self.wires), file=handle)
+        print("# %.3f seconds, %d lines/second" % (elapsed, self.lines / elapsed), file=handle)
 
 
 def parser_main(argv):
-    if len(argv) < 2:
-        print("Usage: %s <file.circuit>"  % (argv[0],))
-        return 1
-    with open(argv[1], 'r') as handle:
+    parser = argparse.ArgumentParser(prog=argv[0], description="Parse a circuit and print it in canonical form")
+    parser.add_argument('--stats', action='store_true',
+                        help="Only count the statements, and report parsing throughput to stderr")
+    parser.add_argument('circuit', metavar='file.circuit')
+    args = parser.parse_args(argv[1:])
+
+    with open(args.circuit, 'r') as handle:
+        if args.stats:
+            stats = ParseStats()
+            for stmt in parse(stats.count_lines(handle)):
+                stats.consume(stmt)
+            stats.report()
+            return 0
         for cmd in parse(handle):
             print(cmd.as_line())
     return 0
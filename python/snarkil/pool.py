@@ -0,0 +1,76 @@
+import multiprocessing
+from collections import deque
+from itertools import islice
+
+
+# The program being evaluated by worker processes, inherited when they're forked
+_PROGRAM = None
+
+
+def fork_pool(program, processes):
+	"""
+	Fork a pool of worker processes which inherit the program as `_PROGRAM`
+	"""
+	global _PROGRAM
+	_PROGRAM = program
+	return multiprocessing.get_context('fork').Pool(processes)
+
+
+def _evaluate_chunk(items, vector):
+	chunk = len(items) if vector else None
+	return list(_PROGRAM.run_batch(items, chunk))
+
+
+class WitnessPool(object):
+	def __init__(self, program, processes=None, chunksize=16, window=None, vector=False):
+		"""
+		Evaluates batches of inputs for a program across multiple processes
+
+		The program must have been parsed and setup, it is compiled (if it hasn't
+		been already) before the workers are forked, so the parsed circuit and its
+		tape are shared copy-on-write between all of the worker processes rather
+		than being pickled and sent to each.
+
+		Inputs are sent to the workers in chunks of `chunksize` items, at most
+		`window` chunks are in-flight at any time, which limits how far ahead of
+		the consumer the input iterable is read.
+		"""
+		if program.tape is None:
+			program.compile()
+		if processes is None:
+			processes = multiprocessing.cpu_count()
+		if window is None:
+			window = processes * 2
+		self.program = program
+		self.chunksize = chunksize
+		self.window = window
+		self.vector = vector
+		self._pool = fork_pool(program, processes)
+
+	def map(self, batch):
+		"""
+		Yields the outputs for each dictionary of input values, in submission order
+		"""
+		batch = iter(batch)
+		pending = deque()
+		while True:
+			while len(pending) < self.window:
+				items = list(islice(batch, self.chunksize))
+				if not items:
+					break
+				pending.append(self._pool.apply_async(_evaluate_chunk, (items, self.vector)))
+			if not pending:
+				break
+			for outputs in pending.popleft().get():
+				yield outputs
+
+	def close(self):
+		self._pool.close()
+		self._pool.join()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self._pool.terminate()
+		self._pool.join()
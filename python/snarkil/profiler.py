@@ -0,0 +1,100 @@
+from __future__ import print_function
+import sys
+import time
+import tracemalloc
+
+from .tape import OPCODE_NAMES
+
+
+class Profiler(object):
+	__slots__ = ('memory', 'entries')
+
+	def __init__(self, memory=False):
+		"""
+		Aggregates the wall time, number of calls and, when `memory` is True,
+		the bytes allocated by each command class at each source line, for every
+		phase of the program: setup, run and constraints. Allocated bytes are the
+		peak growth of traced memory during each call, so temporaries which are
+		freed before the call returns are counted too. Before Python 3.9 the
+		peak can't be reset, so those temporaries are only counted when they
+		exceed the highest peak so far.
+
+		Tracking allocations uses `tracemalloc`, which slows everything down
+		considerably, so it's only enabled when requested.
+		"""
+		self.memory = memory
+		self.entries = dict()
+
+	def _add(self, key, seconds, allocated):
+		entry = self.entries.get(key)
+		if entry is None:
+			entry = self.entries[key] = [0, 0.0, 0]
+		entry[0] += 1
+		entry[1] += seconds
+		entry[2] += allocated
+
+	def each(self, phase, commands, method, state):
+		"""
+		Call `method(cmd, state)` for every command, returns a list of the results
+		"""
+		results = []
+		memory = self.memory
+		started = memory and not tracemalloc.is_tracing()
+		if started:
+			tracemalloc.start()
+		clock = time.perf_counter
+		# Added in Python 3.9
+		reset_peak = getattr(tracemalloc, 'reset_peak', None)
+		allocated = 0
+		try:
+			for cmd in commands:
+				if memory:
+					if reset_peak:
+						reset_peak()
+					start, peak = tracemalloc.get_traced_memory()
+				begin = clock()
+				results.append(method(cmd, state))
+				elapsed = clock() - begin
+				if memory:
+					current, after = tracemalloc.get_traced_memory()
+					# Without reset_peak, the peak only shows this call if it was exceeded
+					allocated = max(current, after if after > peak else 0) - start
+				self._add((phase, type(cmd).__name__, cmd.line_no), elapsed, allocated)
+		finally:
+			if started:
+				tracemalloc.stop()
+		return results
+
+	def execute(self, tape, values):
+		"""
+		Execute the tape one instruction at a time, aggregating by opcode
+		"""
+		clock = time.perf_counter
+		for ins in tape.code:
+			begin = clock()
+			tape.execute(values, (ins,))
+			self._add(('run', OPCODE_NAMES[ins[0]], None), clock() - begin, 0)
+
+	def report(self, handle=sys.stderr, limit=None):
+		"""
+		Flat table of the entries, most time consuming first
+		"""
+		total = sum(_[1] for _ in self.entries.values()) or 1e-9
+		rows = sorted(self.entries.items(), key=lambda _: -_[1][1])
+		print("%-12s %-20s %8s %10s %10s %7s %12s" % (
+			  'phase', 'command', 'line', 'calls', 'seconds', '%', 'bytes'), file=handle)
+		for (phase, name, line_no), (calls, seconds, allocated) in rows[:limit]:
+			print("%-12s %-20s %8s %10d %10.6f %6.2f%% %12d" % (
+				  phase, name, '-' if line_no is None else line_no + 1, calls, seconds,
+				  (seconds / total) * 100, allocated), file=handle)
+
+	def write_collapsed(self, handle):
+		"""
+		Write the entries as collapsed stacks, `phase;command;line microseconds`,
+		which can be rendered by flamegraph.pl or speedscope
+		"""
+		for (phase, name, line_no), (_, seconds, _) in sorted(self.entries.items(), key=str):
+			frames = [phase, name]
+			if line_no is not None:
+				frames.append('line %d' % (line_no + 1,))
+			handle.write("%s %d\n" % (';'.join(frames), int(seconds * 1e6)))
@@ -1,12 +1,24 @@
+from __future__ import print_function
 import re
 import sys
+import argparse
+from itertools import islice
 from collections import OrderedDict
 
 from ethsnarks.field import FQ, int_types
 
-from .commands import make_command
+from .commands import make_command, LutPool
 from .parser import parse, VariableCount, VariableDeclaration
-from .r1cs import State, Constraint
+from .r1cs import State, CompactState, Constraint
+from .tape import Tape
+from .pool import WitnessPool
+from .binary import BinaryCircuit, is_binary
+from .sparse import R1CS
+from .optimize import optimize, OptimizeStats
+from .schedule import Schedule, LevelExecutor, variable_ids
+from .vector import column_from, columns_from, execute_vector, read_vector, prefers_vector
+from .profiler import Profiler
+from .witness import InputFile, is_input_file, write_inputs, write_witness
 
 
 class ProgramError(Exception):
@@ -14,7 +26,21 @@ class ProgramError(Exception):
 
 
 class Program(object):
-	def __init__(self):
+	def __init__(self, compact=False):
+		"""
+		When `compact` is True the state is replaced with a `CompactState` once
+		the `total` header has been parsed, and wire IDs used by the commands
+		are interned into dense integer indices as they're parsed.
+		"""
+		self.compact = compact
+		self.tape = None
+		# Values of the tape slots, as integers, while a tape is attached
+		self.values = None
+		self.r1cs = None
+		self.schedule = None
+		self.evaluated = set()
+		self.luts = LutPool()
+		self.profiler = None
 		self.commands = list()
 		self.total = 0
 		self.state = State()
@@ -26,58 +52,429 @@ class Program(object):
 	def parse_inputs(cls, handle, base=16):
 		"""
 		Given a file handle containing a mapping of variables to values
-		return an ordered dictionary
+		return an ordered dictionary. Values are in `base` unless they have a
+		'0x' or '0b' prefix, blank lines are ignored.
 		"""
 		result = OrderedDict()
-		for line in handle:
-			idx, value = [_.strip() for _ in line.split('=')]
-			if value.startswith('0x'):
-				base = 16
-			elif value.startswith('0b'):
-				base = 2
-			value = int(value, base)
-			result[idx] = value
+		for line in handle.read().splitlines():
+			idx, sep, value = line.partition('=')
+			if not sep:
+				if line.strip():
+					raise ProgramError("Expected 'wire=value', got %r" % (line,))
+				continue
+			value = value.strip()
+			result[idx.strip()] = int(value, 0 if value[:2] in ('0x', '0b') else base)
 		return result
 
 	@classmethod
-	def from_lines(cls, handle):
-		obj = cls()
+	def read_inputs(cls, path):
+		"""
+		Read inputs from a text file, or a binary file written by `write_inputs`
+		in which case the values are returned in the order they were written
+		"""
+		if is_input_file(path):
+			with InputFile(path) as values:
+				return OrderedDict(zip(values.wires, values))
+		with open(path, 'r') as handle:
+			return cls.parse_inputs(handle)
+
+	@classmethod
+	def from_lines(cls, handle, compact=False):
+		obj = cls(compact)
 		obj.parse(handle)
 		return obj
 
+	@classmethod
+	def from_binary(cls, path, compact=False):
+		"""
+		Load a program from a circuit in the binary format, see `snarkil.binary`
+		"""
+		obj = cls(compact)
+		circuit = BinaryCircuit(path)
+		try:
+			for cmd in obj.load_statements(circuit.statements(strings=not compact)):
+				obj.commands.append(cmd)
+		finally:
+			circuit.close()
+		return obj
+
+	@classmethod
+	def from_file(cls, path, compact=False):
+		"""
+		Load a program from either a textual or a binary circuit file
+		"""
+		if is_binary(path):
+			return cls.from_binary(path, compact)
+		with open(path, 'r') as handle:
+			return cls.from_lines(handle, compact)
+
 	def set_values(self, values):
+		"""
+		Assign many inputs or secrets at once, from a dictionary
+		"""
+		assignable = set(self.inputs)
+		assignable.update(self.secrets)
+		state = self.state
+		items = []
 		for idx, value in values.items():
-			self.set_value(idx, value)
+			value = self._field_value(idx, value)
+			if idx not in assignable:
+				raise ProgramError("Cannot set a value (%r=%r) that's neither an input nor a secret" % (idx, value))
+			items.append((state.intern(idx), value))
+		state.var_values_replace(items)
+		self._tape_assign(items)
+		self.evaluated.clear()
 
-	def set_value(self, idx, value):
+	def load_inputs(self, path):
+		"""
+		Assign the inputs then the secrets, in the order they're declared, from
+		a binary input file. The values are read directly from the mapped file.
+		"""
+		wires = self.inputs + self.secrets
+		with InputFile(path) as values:
+			if len(values) != len(wires):
+				raise ProgramError("Input file has %d values, program has %d inputs and secrets" % (len(values), len(wires)))
+			if values.wires != wires:
+				raise ProgramError("Input file is for different inputs or secrets than the program")
+			state = self.state
+			items = list(zip([state.intern(_) for _ in wires], [FQ(_) for _ in values]))
+		state.var_values_replace(items)
+		self._tape_assign(items)
+		self.evaluated.clear()
+
+	def write_inputs(self, handle, values):
+		"""
+		Write the values of the inputs then the secrets to a binary input file
+		"""
+		wires = self.inputs + self.secrets
+		missing = [_ for _ in wires if _ not in values]
+		if missing:
+			raise ProgramError("No values for %r" % (missing,))
+		write_inputs(handle, wires, [int(values[_]) for _ in wires])
+
+	def _field_value(self, idx, value):
 		if not isinstance(value, FQ):
 			if not isinstance(value, int_types):
 				raise ProgramError("Value (%r=%r) is of wrong type: %r" % (idx, value, type(value)))
 			value = FQ(value)
+		return value
+
+	def set_value(self, idx, value):
+		value = self._field_value(idx, value)
 		if idx not in self.inputs and idx not in self.secrets:
 			raise ProgramError("Cannot set a value (%r=%r) that's neither an input nor a secret" % (idx, value))
 		self.state.var_value_set(idx, value)
+		self._tape_assign([(self.state.intern(idx), value)])
+		self.evaluated.clear()
+
+	def _tape_assign(self, items):
+		# Mirror the values of variables, as (idx, value) pairs, onto the tape slots
+		if self.values is not None:
+			slots = self.tape.slots
+			values = self.values
+			for idx, value in items:
+				values[slots[idx]] = value.n
 
 	def value(self, idx):
 		"""
-		Retrieve the value of a variable
+		Retrieve the value of a variable, or a linear combination
 		"""
+		if self.values is not None:
+			return FQ(self.tape.read(self.values, self.tape.terms(self.state, idx)))
 		return self.state.value(idx)
 
+	def optimize(self, stats=None, one_wire=None):
+		"""
+		Fold constants and remove duplicate and dead commands, must be performed
+		before setup. `one_wire` is an input which will always be assigned 1.
+		See `snarkil.optimize`, the counts before and after are added to `stats`.
+		"""
+		return optimize(self, stats, one_wire)
+
 	def setup(self):
+		if self.profiler is not None:
+			self.profiler.each('setup', self.commands, lambda cmd, state: cmd.setup(state), self.state)
+			return
 		for cmd in self.commands:
 			cmd.setup(self.state)
 
+	def variable_order(self):
+		"""
+		All variables in the order of their R1CS columns, must be performed after setup.
+
+		The constant `ONE` is first, followed by the inputs, the secrets,
+		then every other variable in the order it was allocated.
+		"""
+		state = self.state
+		result = [state.ONE]
+		result += [state.var_get(_) for _ in self.inputs]
+		result += [state.var_get(_) for _ in self.secrets]
+		seen = set(_.idx for _ in result)
+		result += [_ for _ in state.variables() if _.idx not in seen]
+		return result
+
+	def constraints(self):
+		"""
+		Iterate through the constraints emitted by every command
+		"""
+		if self.profiler is not None:
+			for constraints in self.profiler.each('constraints', self.commands, lambda cmd, state: cmd.constraints(state), self.state):
+				for constraint in constraints:
+					yield constraint
+			return
+		for cmd in self.commands:
+			for constraint in cmd.constraints(self.state):
+				yield constraint
+
+	def to_r1cs(self):
+		"""
+		Returns the whole constraint system as sparse `A`, `B` and `C` matrices,
+		with linear combinations expanded into the columns of their variables
+		"""
+		r1cs = R1CS(self.variable_order())
+		for constraint in self.constraints():
+			r1cs.append(constraint)
+		return r1cs
+
+	def witness(self, columns=None):
+		"""
+		Values of all variables as integers, in the order of the R1CS columns
+		"""
+		if columns is None:
+			columns = self.variable_order()
+		if self.values is not None:
+			slots = self.tape.slots
+			return [self.values[slots[_.idx]] for _ in columns]
+		return [int(_.evaluate(self.state)) for _ in columns]
+
+	def write_witness(self, handle, columns=None):
+		"""
+		Stream the values of all variables to a binary witness file, in the order
+		of the R1CS columns, must be performed after run
+		"""
+		if columns is None:
+			columns = self.variable_order()
+		if self.values is not None:
+			slots = self.tape.slots
+			values = self.values
+			write_witness(handle, len(columns), (values[slots[_.idx]] for _ in columns))
+			return
+		state = self.state
+		write_witness(handle, len(columns), (state.var_value_get(_.idx).n for _ in columns))
+
+	def check_satisfied(self):
+		"""
+		Verify the current state satisfies every constraint, must be performed after run.
+		Returns the indices of the constraints which aren't satisfied.
+		"""
+		if self.r1cs is None:
+			self.r1cs = self.to_r1cs()
+		return self.r1cs.violated(self.witness(self.r1cs.columns))
+
+	def compile(self):
+		"""
+		Lower the commands into a straight-line `Tape`, must be performed after setup.
+		Subsequent calls to `run` will execute the tape instead of each command.
+
+		The values of the tape's slots are kept as integers by the program, and
+		aren't copied back into the state, so `value` and `witness` must be used
+		to read them rather than the state.
+		"""
+		self.tape = Tape.from_commands(self.state, self.commands)
+		self.values = self.tape.load(self.state)
+		return self.tape
+
+	def levels(self):
+		"""
+		Returns the `Schedule` of commands by dependency level, must be performed after setup
+		"""
+		if self.schedule is None:
+			self.schedule = Schedule(self.state, self.commands)
+		return self.schedule
+
+	def run_parallel(self, processes=None):
+		"""
+		Evaluate the commands of each level in the schedule across worker processes
+		"""
+		self.levels()
+		with LevelExecutor(self, processes) as executor:
+			executor.run()
+		if self.tape is not None:
+			# Commands were evaluated with the state, copy their results onto the tape
+			self.values = self.tape.load(self.state, range(self.tape.n_vars))
+
+	def update(self, values):
+		"""
+		Assign new values to some of the inputs or secrets, then re-evaluate only
+		the commands downstream of them, returning the values of the outputs.
+		The program must have been run with the previous values.
+
+		When compiled, only the instructions emitted by those commands are executed.
+		"""
+		schedule = self.levels()
+		changed = []
+		for idx, value in values.items():
+			self.set_value(idx, value)
+			changed.append(self.state.var_get(idx).idx)
+		self._evaluate_subset(schedule.downstream(changed))
+		return OrderedDict((idx, self.value(idx)) for idx in self.outputs)
+
+	def evaluate_outputs(self, outputs):
+		"""
+		Evaluate only the commands which the given wires depend upon, returning their values.
+
+		Commands evaluated by previous calls are skipped until any input or secret
+		is assigned, so querying outputs which share a sub-circuit is cumulative.
+		When compiled, only the instructions emitted by those commands are executed.
+		"""
+		schedule = self.levels()
+		needed = []
+		for idx in outputs:
+			needed += variable_ids(self.state, idx)
+		pending = [_ for _ in schedule.upstream(needed) if _ not in self.evaluated]
+		self._evaluate_subset(pending)
+		self.evaluated.update(pending)
+		return OrderedDict((idx, self.value(idx)) for idx in outputs)
+
+	def _evaluate_subset(self, indices):
+		# Evaluate the commands at the indices, which are in order
+		if self.tape is not None:
+			self.tape.execute(self.values, self.tape.instructions(indices))
+			return
+		for i in indices:
+			self.commands[i].evaluate(self.state)
+
 	def run(self):
+		profiler = self.profiler
+		if self.tape is not None:
+			if profiler is not None:
+				profiler.execute(self.tape, self.values)
+				return
+			self.tape.execute(self.values)
+			return
+		if profiler is not None:
+			profiler.each('run', self.commands, lambda cmd, state: cmd.evaluate(state), self.state)
+			return
 		for cmd in self.commands:
 			cmd.evaluate(self.state)
 
+	def input_slots(self):
+		"""
+		Map the index of every input and secret to its slot on the tape
+		"""
+		tape = self.tape
+		return {idx: tape.slots[self.state.var_get(idx).idx]
+				for idx in self.inputs + self.secrets}
+
+	def _input_value(self, slots, idx, value):
+		if idx not in slots:
+			raise ProgramError("Cannot set a value (%r=%r) that's neither an input nor a secret" % (idx, value))
+		if not isinstance(value, int_types):
+			if not isinstance(value, FQ):
+				raise ProgramError("Value (%r=%r) is of wrong type: %r" % (idx, value, type(value)))
+			value = int(value)
+		return value % self.tape.modulus
+
+	def run_batch(self, batch, chunk=None):
+		"""
+		Evaluate the program once for each dictionary of input values in `batch`,
+		yielding an ordered dictionary of the output values for each, in order.
+
+		The program is compiled if it hasn't been already, and each evaluation
+		starts from the values currently assigned in the state, so any inputs or
+		secrets which are common to every item can be set beforehand with `set_values`.
+		The state itself is left unmodified.
+
+		When `chunk` is given, up to that many items are gathered from `batch` and
+		evaluated together by the vectorised evaluator, which requires numpy. It's
+		only used when most of the tape is table lookups, otherwise evaluating each
+		item in turn is faster.
+		"""
+		if self.tape is None:
+			self.compile()
+		if chunk is not None and prefers_vector(self.tape):
+			for outputs in self._run_batch_vector(batch, chunk):
+				yield outputs
+			return
+
+		tape = self.tape
+		template = tape.load(self.state)
+		slots = self.input_slots()
+		readers = [(idx, tape.terms(self.state, idx)) for idx in self.outputs]
+
+		for values in batch:
+			work = list(template)
+			for idx, value in values.items():
+				work[slots[idx]] = self._input_value(slots, idx, value)
+			tape.execute(work)
+			yield OrderedDict((idx, FQ(tape.read(work, terms)))
+							  for idx, terms in readers)
+
+	def _run_batch_vector(self, batch, chunk):
+		tape = self.tape
+		template = tape.load(self.state)
+		slots = self.input_slots()
+		readers = [(idx, tape.terms(self.state, idx)) for idx in self.outputs]
+
+		batch = iter(batch)
+		while True:
+			items = list(islice(batch, chunk))
+			if not items:
+				break
+			n = len(items)
+			columns = columns_from(template, n)
+			for idx in set().union(*items):
+				slot = slots.get(idx)
+				default = template[slot] if slot is not None else None
+				columns[slot] = column_from([
+					self._input_value(slots, idx, values[idx]) if idx in values else default
+					for values in items])
+			execute_vector(tape, columns, n)
+			outputs = [(idx, read_vector(tape, columns, terms, n)) for idx, terms in readers]
+			for i in range(n):
+				yield OrderedDict((idx, FQ(int(values[i]))) for idx, values in outputs)
+
 	def parse(self, handle, first=True):
-		for item in parse(handle):
+		for cmd in self.iter_commands(handle, first):
+			self.commands.append(cmd)
+
+	def run_stream(self, handle, values):
+		"""
+		Parse, setup and evaluate each command as it's read from the circuit,
+		without retaining the commands. Input and secret values are assigned as
+		soon as they've been declared. Returns the values of the outputs.
+		"""
+		for cmd in self.iter_commands(handle, values=values):
+			cmd.setup(self.state)
+			cmd.evaluate(self.state)
+		return OrderedDict((idx, self.value(idx)) for idx in self.outputs)
+
+	def iter_commands(self, handle, first=True, values=None):
+		"""
+		Parse the circuit, handling the header and variable declarations,
+		yielding each command as it's parsed without retaining it
+		"""
+		return self.load_statements(parse(handle, lines=True), first, values)
+
+	def load_statements(self, statements, first=True, values=None):
+		"""
+		Yields commands from parsed statements, which may be `(statement, line)` pairs
+
+		When `values` is given each is assigned as soon as its input or secret is
+		declared. Inputs and secrets are declared before the first command, so any
+		value still pending when the first command is reached can't be assigned.
+		"""
+		pending = OrderedDict(values or ())
+		for item in statements:
+			line = None
+			if isinstance(item, tuple):
+				item, line = item
 			if first:
 				if not isinstance(item, VariableCount):
 					raise ProgramError("First line is required to be 'total'")
 				self.total = item.total
+				if self.compact:
+					self.state = CompactState(self.total)
 				first = False
 				continue
 			elif isinstance(item, VariableDeclaration):
@@ -86,31 +483,133 @@ class Program(object):
 					self.inputs.append(item.idx)
 				elif item.is_output:
 					self.outputs.append(item.idx)
+					continue
 				elif item.is_secret:
 					self.state.var_new(item.idx)
 					self.secrets.append(item.idx)
 				else:
 					raise ProgramError("Unknown type of variable: %r" % (type(item),))
+				if item.idx in pending:
+					self.state.var_value_set(item.idx, self._field_value(item.idx, pending.pop(item.idx)))
 			else:
-				cmd = make_command(item)
-				self.commands.append(cmd)
+				if pending:
+					raise ProgramError("Cannot set values for %r, neither inputs nor secrets" % (list(pending),))
+				if self.compact:
+					item.in_vars = [self.state.intern_wire(_) for _ in item.in_vars]
+					item.out_vars = [self.state.intern_wire(_) for _ in item.out_vars]
+				yield make_command(item, line, luts=self.luts)
+		if pending:
+			raise ProgramError("Cannot set values for %r, neither inputs nor secrets" % (list(pending),))
+
+
+def iter_input_files(paths):
+	for path in paths:
+		yield Program.read_inputs(path)
 
 
 def program_main(argv):
-	if len(argv) < 3:
-		print("Usage: %s <file.circuit> <file.input>" % (argv[0],))
+	parser = argparse.ArgumentParser(prog=argv[0], description="Evaluate a circuit with the given inputs")
+	parser.add_argument('--compact', action='store_true', help="Use dense integer wire indices for the state")
+	parser.add_argument('--compile', action='store_true', help="Execute a compiled tape rather than each command")
+	parser.add_argument('--batch', action='store_true',
+						help="Evaluate every input file in turn, file names are read from stdin if none are given")
+	parser.add_argument('--vector', metavar='N', type=int,
+						help="With --batch, evaluate up to N inputs at a time with the vectorised evaluator, for table-heavy circuits")
+	parser.add_argument('--processes', metavar='N', type=int,
+						help="With --batch, evaluate inputs across N worker processes")
+	parser.add_argument('--check', action='store_true',
+						help="Verify the witness satisfies every constraint after evaluating")
+	parser.add_argument('--r1cs', metavar='FILE',
+						help="Write the constraint system as sparse matrices to the file")
+	parser.add_argument('--optimize', action='store_true',
+						help="Fold constants, remove duplicate and dead commands, reporting the constraint counts to stderr")
+	parser.add_argument('--one', metavar='WIRE',
+						help="With --optimize, the input wire which is always 1 (the 'one-input')")
+	parser.add_argument('--levels', action='store_true',
+						help="Report the dependency levels and critical path of the circuit to stderr")
+	parser.add_argument('--parallel', metavar='N', type=int,
+						help="Evaluate the independent commands of each level across N processes")
+	parser.add_argument('--profile', metavar='FILE',
+						help="Time every command, writing collapsed stacks to the file and a summary to stderr")
+	parser.add_argument('--profile-memory', action='store_true',
+						help="With --profile, also measure the bytes allocated by every command")
+	parser.add_argument('--write-inputs', metavar='FILE',
+						help="Write the inputs as a binary file, which can be given in place of file.input")
+	parser.add_argument('--witness', metavar='FILE',
+						help="Write the values of all variables, in the order of the R1CS columns, as a binary file")
+	parser.add_argument('circuit', metavar='file.circuit')
+	parser.add_argument('inputs', metavar='file.input', nargs='*')
+	args = parser.parse_args(argv[1:])
+
+	if not args.batch and len(args.inputs) != 1 and not (args.r1cs and not args.inputs):
+		parser.print_usage()
 		return 1
 
-	with open(argv[1], 'r') as circuit_handle:
-		program = Program.from_lines(circuit_handle)
+	stats = OptimizeStats() if args.optimize else None
+	profiler = Profiler(args.profile_memory) if args.profile else None
+	program = Program.from_file(args.circuit, args.compact)
+	if stats is not None:
+		program.optimize(stats, args.one)
+	program.profiler = profiler
+	program.setup()
+	if stats is not None:
+		stats.report()
+	if args.levels:
+		program.levels().report()
 
-	with open(argv[2], 'r') as input_handle:
-		inputs = Program.parse_inputs(input_handle)
+	if args.r1cs:
+		with open(args.r1cs, 'wb') as r1cs_handle:
+			program.to_r1cs().write(r1cs_handle)
+		if not args.inputs:
+			return 0
+
+	if args.batch:
+		paths = args.inputs or [_.strip() for _ in sys.stdin if _.strip()]
+		if args.processes:
+			pool = WitnessPool(program, args.processes, chunksize=args.vector or 16, vector=bool(args.vector))
+			results = pool.map(iter_input_files(paths))
+		else:
+			results = program.run_batch(iter_input_files(paths), args.vector)
+		for path, outputs in zip(paths, results):
+			print("# %s" % (path,))
+			for idx, value in outputs.items():
+				print("%s=%s" % (str(idx), str(value)))
+			sys.stdout.flush()
+		if args.processes:
+			pool.close()
+		return 0
+
+	if args.write_inputs:
+		with open(args.inputs[0], 'r') as input_handle, open(args.write_inputs, 'wb') as output_handle:
+			program.write_inputs(output_handle, Program.parse_inputs(input_handle))
 
 	# Setup then run program with given inputs
-	program.setup()
-	program.set_values(inputs)
-	program.run()
+	if args.compile:
+		program.compile()
+	if is_input_file(args.inputs[0]):
+		program.load_inputs(args.inputs[0])
+	else:
+		with open(args.inputs[0], 'r') as input_handle:
+			program.set_values(Program.parse_inputs(input_handle))
+	if args.parallel:
+		program.run_parallel(args.parallel)
+	else:
+		program.run()
+
+	if args.check:
+		violated = program.check_satisfied()
+		if violated:
+			print("Error: %d constraints not satisfied, first is #%d" % (len(violated), violated[0]), file=sys.stderr)
+			return 2
+
+	if profiler is not None:
+		with open(args.profile, 'w') as profile_handle:
+			profiler.write_collapsed(profile_handle)
+		profiler.report(limit=20)
+
+	if args.witness:
+		with open(args.witness, 'wb') as witness_handle:
+			program.write_witness(witness_handle)
 
 	# Display program outputs on console
 	for idx in program.outputs:
@@ -8,7 +8,7 @@ from ethsnarks.field import FQ, int_types
 
 
 class State(object):
-	__slots__ = ('_vars', '_lcs', '_values')
+	__slots__ = ('_vars', '_lcs', '_values', '_lc_values', '_lc_deps')
 
 	def __init__(self):
 		"""
@@ -34,10 +34,15 @@ class State(object):
 		any combination of variables or linear combinations, as can the outputs.
 
 		If a linear combination or variable is unused by any constraints then it has no purpose.
+
+		The value of a linear combination is cached when it's first read, the cached
+		value is discarded whenever one of the variables it refers to is set.
 		"""
 		self._vars = OrderedDict()
 		self._lcs = dict()
 		self._values = dict()
+		self._lc_values = dict()
+		self._lc_deps = dict()
 		self.var_new('ONE', value=FQ(1))
 
 	def constant(self, value):
@@ -65,12 +70,33 @@ class State(object):
 	def __contains__(self, idx):
 		return idx in self._vars or idx in self._lcs
 
+	def intern(self, idx):
+		"""
+		Translate an external wire ID into the index used internally by the state
+		"""
+		return idx
+
 	def value(self, idx):
 		"""
 		Get the value for an index, doesn't matter if it's a linear combination or a variable
 		"""		
 		var = self[idx]
-		return var.evaluate(self)
+		if isinstance(var, Variable):
+			return var.evaluate(self)
+		value = self._lc_values.get(var)
+		if value is None:
+			value = self._lc_values[var] = var.evaluate(self)
+		return value
+
+	def _lc_depends(self, lc):
+		# Record the linear combinations which refer to each variable
+		deps = self._lc_deps
+		for term in lc:
+			deps.setdefault(term.var.idx, []).append(lc)
+
+	def _lc_invalidate(self, idx):
+		for lc in self._lc_deps.get(idx, ()):
+			self._lc_values.pop(lc, None)
 
 	def _random_idx(self):
 		# Auto-generate a new random ID for this variable
@@ -106,6 +132,7 @@ class State(object):
 			raise RuntimeError('Unknown variable %r' % (idx,))
 
 		self._values[idx] = value
+		self._lc_invalidate(idx)
 
 	def var_value_get(self, idx):
 		if isinstance(idx, Variable):
@@ -115,6 +142,39 @@ class State(object):
 	def var_get(self, idx):
 		return self._vars[idx]
 
+	def variables(self):
+		"""
+		Iterate through all variables, in the order they were allocated
+		"""
+		return iter(self._vars.values())
+
+	def var_values_update(self, items):
+		"""
+		Bulk assignment of field elements to variables, given (idx, value) pairs
+
+		No type or existence checks are performed, the indices must come from
+		variables already allocated by this state, and the values must be FQ
+		"""
+		values = self._values
+		cached = self._lc_values
+		deps = self._lc_deps
+		for idx, value in items:
+			values[idx] = value
+			if cached:
+				for lc in deps.get(idx, ()):
+					cached.pop(lc, None)
+
+	def var_values_replace(self, items):
+		"""
+		As `var_values_update`, but for assigning many variables at once (such as
+		every input, or every variable written by a tape), where discarding all
+		cached linear combination values is cheaper than finding those affected
+		"""
+		values = self._values
+		for idx, value in items:
+			values[idx] = value
+		self._lc_values.clear()
+
 	def lc_create(self, lc, idx=None):
 		if idx is None:
 			idx = self._random_idx()
@@ -123,17 +183,177 @@ class State(object):
 			lc = Combination(lc)
 		if not isinstance(lc, Combination):
 			raise TypeError('Expected Combination, got %r' % (type(lc),))
+		lc = lc.canonical()
 		if idx in self._vars:
 			raise RuntimeError("Cannot create duplicate index")
 		if idx in self._lcs:
 			raise RuntimeError("Cannot override linear combination with a new variable")
 		self._lcs[idx] = lc
+		self._lc_depends(lc)
 		return lc
 
 	def lc_get(self, idx):
 		return self._lcs[idx]
 
 
+class CompactState(State):
+	__slots__ = ('total', '_names', '_order')
+
+	def __init__(self, total):
+		"""
+		A state where every variable and linear combination lives in a dense slot
+
+		Wire IDs are interned into integers, the numeric wires `0 .. total-1` from
+		the pinocchio format map directly onto slots of the same number. The `ONE`
+		variable is stored at slot `total`, and auxiliary variables, plus any wire
+		which is non-numeric or lies outside the declared total, are allocated from
+		a counter above it.
+
+		Values, variables and linear combinations are kept in preallocated lists
+		rather than dictionaries, so a lookup by interned index is a list access.
+		Variables are also listed in the order they were created, as they are by
+		`State`, so both give the same R1CS column order.
+		"""
+		self.total = total
+		self._names = dict()
+		self._order = list()
+		self._lc_values = dict()
+		self._lc_deps = dict()
+		self._vars = [None] * (total + 1)
+		self._lcs = [None] * (total + 1)
+		self._values = [None] * (total + 1)
+		self._names['ONE'] = total
+		self.var_new(total, value=FQ(1))
+
+	@property
+	def ONE(self):
+		return self._vars[self.total]
+
+	def intern(self, idx):
+		if isinstance(idx, Variable):
+			return idx.idx
+		if isinstance(idx, int_types):
+			return idx
+		return self.intern_wire(idx)
+
+	def intern_wire(self, wire):
+		"""
+		Slot for a wire ID from a circuit, either a string or an integer
+
+		Unlike `intern`, integers are treated as wire IDs rather than slots
+		"""
+		if isinstance(wire, int_types) and 0 <= wire < self.total:
+			return wire
+		wire = str(wire)
+		slot = self._names.get(wire)
+		if slot is not None:
+			return slot
+		try:
+			slot = int(wire)
+		except ValueError:
+			slot = -1
+		if slot < 0 or slot >= self.total:
+			slot = self._random_idx()
+			self._names[wire] = slot
+		return slot
+
+	def __getitem__(self, idx):
+		idx = self.intern(idx)
+		if idx < len(self._lcs):
+			# Prefer linear combinations first
+			lc = self._lcs[idx]
+			if lc is not None:
+				return lc
+			var = self._vars[idx]
+			if var is not None:
+				return var
+		raise KeyError('Variable or Linear Combination not found!')
+
+	def __contains__(self, idx):
+		idx = self.intern(idx)
+		if idx >= len(self._lcs):
+			return False
+		return self._vars[idx] is not None or self._lcs[idx] is not None
+
+	def _random_idx(self):
+		# Auxiliary slots are allocated sequentially above `total`
+		idx = len(self._vars)
+		self._vars.append(None)
+		self._lcs.append(None)
+		self._values.append(None)
+		return idx
+
+	def var_new(self, idx=None, title=None, value=None):
+		if idx is None:
+			idx = self._random_idx()
+		else:
+			idx = self.intern(idx)
+		if self._vars[idx] is not None:
+			raise RuntimeError("Cannot create duplicate index")
+		if self._lcs[idx] is not None:
+			raise RuntimeError("Cannot override linear combination with a new variable")
+		var = Variable(idx, title)
+		self._vars[idx] = var
+		self._order.append(var)
+		if value is not None:
+			assert isinstance(value, FQ)
+			self._values[idx] = value
+		return var
+
+	def var_value_set(self, idx, value):
+		idx = self.intern(idx)
+		if not isinstance(value, FQ):
+			if isinstance(value, int_types):
+				value = FQ(value)
+			else:
+				raise TypeError("Value (%r=%r) of type %r is required to be a field element" % (idx, value, type(value)))
+		if idx >= len(self._vars) or self._vars[idx] is None:
+			raise RuntimeError('Unknown variable %r' % (idx,))
+
+		self._values[idx] = value
+		self._lc_invalidate(idx)
+
+	def var_value_get(self, idx):
+		value = self._values[self.intern(idx)]
+		if value is None:
+			raise KeyError(idx)
+		return value
+
+	def var_get(self, idx):
+		var = self._vars[self.intern(idx)]
+		if var is None:
+			raise KeyError(idx)
+		return var
+
+	def variables(self):
+		return iter(self._order)
+
+	def lc_create(self, lc, idx=None):
+		if idx is None:
+			idx = self._random_idx()
+		else:
+			idx = self.intern(idx)
+		if isinstance(lc, Term):
+			# Upgrade a Term to a Linear Combination
+			lc = Combination(lc)
+		if not isinstance(lc, Combination):
+			raise TypeError('Expected Combination, got %r' % (type(lc),))
+		lc = lc.canonical()
+		if self._vars[idx] is not None:
+			raise RuntimeError("Cannot create duplicate index")
+		if self._lcs[idx] is not None:
+			raise RuntimeError("Cannot override linear combination with a new variable")
+		self._lcs[idx] = lc
+		self._lc_depends(lc)
+		return lc
+
+	def lc_get(self, idx):
+		lc = self._lcs[self.intern(idx)]
+		if lc is None:
+			raise KeyError(idx)
+		return lc
+
+
 class Variable(object):
 	__slots__ = ('idx', 'title')
 
@@ -221,7 +441,26 @@ class Combination(object):
 
 	def evaluate(self, state):
 		assert isinstance(state, State)
-		return reduce(operator.add, (term.evaluate(state) for term in self.terms))
+		return reduce(operator.add, (term.evaluate(state) for term in self.terms), FQ(0))
+
+	def canonical(self):
+		"""
+		Returns an equivalent combination with the coefficients of duplicate
+		variables merged, terms with a zero coefficient removed, and the
+		remaining terms sorted by the index of their variable.
+		"""
+		coeffs = dict()
+		variables = dict()
+		for term in self.terms:
+			idx = term.var.idx
+			if idx in coeffs:
+				coeffs[idx] = coeffs[idx] + term.coeff
+			else:
+				coeffs[idx] = term.coeff
+				variables[idx] = term.var
+		order = sorted(coeffs, key=lambda idx: (type(idx).__name__, idx))
+		terms = [Term(variables[idx], coeffs[idx]) for idx in order if coeffs[idx] != 0]
+		return Combination(*terms, title=self.title)
 
 	def __iter__(self):
 		return iter(self.terms)
@@ -232,7 +471,7 @@ class Combination(object):
 
 	def __add__(self, other):
 		if isinstance(other, Combination):
-			return Combination(self.terms + other.terms)
+			return Combination(*(self.terms + other.terms))
 		elif isinstance(other, (Variable, Term)):
 			if isinstance(other, Variable):
 				other = Term(other)
@@ -0,0 +1,190 @@
+from __future__ import print_function
+import sys
+import multiprocessing
+
+from ethsnarks.field import FQ
+
+from . import pool
+from .r1cs import Variable
+from .commands import AssertCommand
+
+
+def variable_ids(state, idx):
+	"""
+	Indices of the variables which hold the value of an index, a linear
+	combination depends on every variable it refers to
+	"""
+	item = state[idx]
+	if isinstance(item, Variable):
+		return [item.idx]
+	return [term.var.idx for term in item]
+
+
+def command_reads(state, cmd):
+	result = []
+	for idx in cmd.inputs:
+		result += variable_ids(state, idx)
+	if isinstance(cmd, AssertCommand):
+		# The output of an assert is read, not written
+		result += variable_ids(state, cmd.outputs[0])
+	return result
+
+
+def command_writes(state, cmd):
+	"""
+	Variables assigned when the command is evaluated, linear combinations
+	produced by the command aren't assigned, so don't count
+	"""
+	if isinstance(cmd, AssertCommand):
+		return []
+	result = [state[_].idx for _ in cmd.outputs if isinstance(state[_], Variable)]
+	result += [_.idx for _ in (cmd.aux or [])]
+	return result
+
+
+def _evaluate_commands(indices, values):
+	program = pool._PROGRAM
+	state = program.state
+	state.var_values_replace([(idx, FQ(value)) for idx, value in values])
+	written = []
+	for i in indices:
+		cmd = program.commands[i]
+		cmd.evaluate(state)
+		written += [(idx, int(state.var_value_get(idx))) for idx in program.schedule.writes[i]]
+	return written
+
+
+class Schedule(object):
+	__slots__ = ('levels', 'reads', 'writes', 'readers', 'writer', 'critical_path', 'work')
+
+	def __init__(self, state, commands):
+		"""
+		Groups commands into levels by their dependencies, must be performed after setup
+
+		Every command in a level depends only on variables written by commands
+		in earlier levels, so all of the commands in a level can be evaluated in
+		any order, or at the same time. Commands which only produce linear
+		combinations do no work when evaluated, and aren't scheduled.
+
+		The work of a command is the number of variables it assigns, the critical
+		path is the most work which must be performed one command after another.
+		"""
+		writer = self.writer = dict()
+		finish = dict()
+		level_of = dict()
+		self.levels = []
+		self.reads = []
+		self.writes = []
+		self.readers = dict()
+		self.critical_path = 0
+		self.work = 0
+		for i, cmd in enumerate(commands):
+			reads = command_reads(state, cmd)
+			writes = command_writes(state, cmd)
+			self.reads.append(reads)
+			self.writes.append(writes)
+			for idx in set(reads):
+				self.readers.setdefault(idx, []).append(i)
+			if not writes and not isinstance(cmd, AssertCommand):
+				continue
+			deps = set(writer[_] for _ in reads if _ in writer)
+			level = max([level_of[_] + 1 for _ in deps] or [0])
+			if level == len(self.levels):
+				self.levels.append([])
+			self.levels[level].append(i)
+			level_of[i] = level
+			finish[i] = len(writes) + max([finish[_] for _ in deps] or [0])
+			for idx in writes:
+				writer[idx] = i
+			self.work += len(writes)
+			self.critical_path = max(self.critical_path, finish[i])
+
+	def downstream(self, variables):
+		"""
+		Indices of the commands which transitively depend on any of the variables,
+		in the order they must be evaluated
+		"""
+		result = set()
+		pending = list(variables)
+		while pending:
+			for i in self.readers.get(pending.pop(), ()):
+				if i not in result:
+					result.add(i)
+					pending += self.writes[i]
+		return sorted(result)
+
+	def upstream(self, variables):
+		"""
+		Indices of the commands which the values of the variables transitively
+		depend upon, in the order they must be evaluated
+		"""
+		result = set()
+		pending = list(variables)
+		while pending:
+			i = self.writer.get(pending.pop())
+			if i is not None and i not in result:
+				result.add(i)
+				pending += self.reads[i]
+		return sorted(result)
+
+	def report(self, handle=sys.stderr):
+		n_commands = sum(len(_) for _ in self.levels)
+		print("# %d commands in %d levels, widest level has %d commands" % (
+			  n_commands, len(self.levels), max([len(_) for _ in self.levels] or [0])), file=handle)
+		print("# critical path %d of %d total work, parallelism %.2f" % (
+			  self.critical_path, self.work, self.work / max(self.critical_path, 1)), file=handle)
+
+
+class LevelExecutor(object):
+	def __init__(self, program, processes=None, min_parallel=None):
+		"""
+		Evaluates the program one level of its `Schedule` at a time, with the
+		commands of each level spread across multiple processes.
+
+		Workers are forked once, sharing the program copy-on-write. For each level
+		they're sent the values of the variables their commands read, and return
+		the values of the variables written. Levels with fewer than `min_parallel`
+		commands are evaluated by the calling process.
+		"""
+		if program.schedule is None:
+			program.schedule = Schedule(program.state, program.commands)
+		if processes is None:
+			processes = multiprocessing.cpu_count()
+		if min_parallel is None:
+			min_parallel = processes * 2
+		self.program = program
+		self.processes = processes
+		self.min_parallel = min_parallel
+		self._pool = pool.fork_pool(program, processes)
+
+	def run(self):
+		program = self.program
+		state = program.state
+		schedule = program.schedule
+		for level in schedule.levels:
+			if len(level) < self.min_parallel:
+				for i in level:
+					program.commands[i].evaluate(state)
+				continue
+			step = -(-len(level) // self.processes)
+			tasks = []
+			for start in range(0, len(level), step):
+				indices = level[start:start + step]
+				reads = set()
+				for i in indices:
+					reads.update(schedule.reads[i])
+				values = [(idx, int(state.var_value_get(idx))) for idx in reads]
+				tasks.append(self._pool.apply_async(_evaluate_commands, (indices, values)))
+			for task in tasks:
+				state.var_values_update([(idx, FQ(value)) for idx, value in task.get()])
+
+	def close(self):
+		self._pool.close()
+		self._pool.join()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self._pool.terminate()
+		self._pool.join()
@@ -0,0 +1,167 @@
+import sys
+import struct
+import operator
+from array import array
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+from ethsnarks.field import SNARK_SCALAR_FIELD
+
+from .r1cs import Constraint, Combination
+
+
+MAGIC = b'SNKR1CS\x00'
+VERSION = 1
+
+# magic, version, number of columns, number of rows
+HEADER = struct.Struct('<8sIQQ')
+
+FIELD_BYTES = 32
+
+
+class SparseMatrix(object):
+	__slots__ = ('indptr', 'indices', 'data')
+
+	def __init__(self):
+		"""
+		Matrix in compressed sparse row (CSR) form
+
+		The columns and coefficients of row `i` are found at positions
+		`indptr[i]` up to `indptr[i+1]` of `indices` and `data` respectively.
+		Coefficients are integers reduced modulo the field.
+		"""
+		self.indptr = array('Q', [0])
+		self.indices = array('I')
+		self.data = list()
+
+	@property
+	def n_rows(self):
+		return len(self.indptr) - 1
+
+	@property
+	def nnz(self):
+		return len(self.data)
+
+	def append_row(self, columns, coeffs):
+		self.indices.extend(columns)
+		self.data.extend(coeffs)
+		self.indptr.append(len(self.data))
+
+	def row(self, i):
+		start, end = self.indptr[i], self.indptr[i + 1]
+		return self.indices[start:end], self.data[start:end]
+
+	def dot(self, witness, modulus):
+		"""
+		Sparse matrix-vector product over the field, returns a list with one value per row
+		"""
+		if numpy is not None:
+			return self._dot_numpy(witness, modulus)
+		indices = self.indices
+		data = self.data
+		indptr = self.indptr
+		lookup = witness.__getitem__
+		mul = operator.mul
+		return [sum(map(mul, map(lookup, indices[indptr[i]:indptr[i + 1]]), data[indptr[i]:indptr[i + 1]])) % modulus
+				for i in range(self.n_rows)]
+
+	def _dot_numpy(self, witness, modulus):
+		n_rows = self.n_rows
+		if not self.nnz:
+			return [0] * n_rows
+		w = numpy.empty(len(witness), dtype=object)
+		w[:] = witness
+		data = numpy.empty(self.nnz, dtype=object)
+		data[:] = self.data
+		products = w[numpy.frombuffer(self.indices, dtype=numpy.uint32)] * data
+		indptr = numpy.frombuffer(self.indptr, dtype=numpy.uint64).astype(numpy.int64)
+		starts = indptr[:-1]
+		nonempty = starts < indptr[1:]
+		result = numpy.zeros(n_rows, dtype=object)
+		# reduceat sums each run between consecutive starts, empty rows are skipped
+		result[nonempty] = numpy.add.reduceat(products, starts[nonempty])
+		return (result % modulus).tolist()
+
+	def write(self, handle):
+		indptr = self.indptr
+		indices = self.indices
+		if sys.byteorder != 'little':
+			indptr = array('Q', indptr)
+			indices = array('I', indices)
+			indptr.byteswap()
+			indices.byteswap()
+		handle.write(struct.pack('<Q', self.nnz))
+		handle.write(indptr.tobytes())
+		handle.write(indices.tobytes())
+		for coeff in self.data:
+			handle.write(coeff.to_bytes(FIELD_BYTES, 'little'))
+
+
+class R1CS(object):
+	__slots__ = ('A', 'B', 'C', 'columns', 'column_of', 'modulus')
+
+	def __init__(self, columns, modulus=SNARK_SCALAR_FIELD):
+		"""
+		A rank-1 constraint system `(A . w) * (B . w) = (C . w)` as sparse matrices
+
+		`columns` is the list of variables, the position of each variable in the
+		list is its column in the matrices and its index in the witness vector `w`.
+		"""
+		self.A = SparseMatrix()
+		self.B = SparseMatrix()
+		self.C = SparseMatrix()
+		self.columns = columns
+		self.column_of = {var.idx: i for i, var in enumerate(columns)}
+		self.modulus = modulus
+
+	@property
+	def n_constraints(self):
+		return self.A.n_rows
+
+	def row(self, lc):
+		"""
+		Columns and coefficients for a linear combination, with the coefficients
+		of duplicate variables merged and zero coefficients removed
+		"""
+		assert isinstance(lc, Combination)
+		merged = dict()
+		column_of = self.column_of
+		for term in lc:
+			col = column_of[term.var.idx]
+			merged[col] = (merged.get(col, 0) + int(term.coeff)) % self.modulus
+		columns = sorted(_ for _ in merged if merged[_] != 0)
+		return columns, [merged[_] for _ in columns]
+
+	def violated(self, witness):
+		"""
+		Returns the indices of the constraints which aren't satisfied by the witness,
+		which holds the value of every column as an integer
+		"""
+		p = self.modulus
+		a = self.A.dot(witness, p)
+		b = self.B.dot(witness, p)
+		c = self.C.dot(witness, p)
+		return [i for i, (x, y, z) in enumerate(zip(a, b, c)) if (x * y) % p != z]
+
+	def append(self, constraint):
+		assert isinstance(constraint, Constraint)
+		self.A.append_row(*self.row(constraint.a))
+		self.B.append_row(*self.row(constraint.b))
+		self.C.append_row(*self.row(constraint.c))
+
+	def write(self, handle):
+		"""
+		Write the constraint system to a binary file handle
+
+		After the header follows each of the A, B and C matrices, every matrix
+		begins with its number of non-zero entries as a 64bit integer, then
+		`n_constraints + 1` 64bit row pointers, the 32bit column indices, and
+		finally every coefficient as a 32 byte field element. All integers are
+		little-endian.
+		"""
+		handle.write(HEADER.pack(MAGIC, VERSION, len(self.columns), self.n_constraints))
+		for matrix in (self.A, self.B, self.C):
+			matrix.write(handle)
@@ -0,0 +1,255 @@
+from ethsnarks.field import FQ, SNARK_SCALAR_FIELD
+
+from .r1cs import State, Variable, Combination
+
+
+OP_LC = 0
+OP_MUL = 1
+OP_XOR = 2
+OP_AND = 3
+OP_OR = 4
+OP_ZEROP = 5
+OP_ASSERT = 6
+OP_SPLIT = 7
+OP_TABLE = 8
+OP_MUX = 9
+
+OPCODE_NAMES = ['OP_LC', 'OP_MUL', 'OP_XOR', 'OP_AND', 'OP_OR', 'OP_ZEROP', 'OP_ASSERT', 'OP_SPLIT', 'OP_TABLE', 'OP_MUX']
+
+# Values of the characters of a binary string
+BITS = {'0': 0, '1': 1}
+
+
+class Tape(object):
+	__slots__ = ('code', 'slots', 'labels', 'n_vars', 'n_slots', 'loads', 'stores', 'modulus', 'ranges', 'reused', '_lc_slots')
+
+	def __init__(self, state, modulus=SNARK_SCALAR_FIELD):
+		"""
+		A straight-line program, lowered from the commands after `Program.setup()`
+
+		Every variable in the state is given an integer slot, the first `n_vars`
+		slots hold variables and any further slots hold the values of linear
+		combinations which have been materialised as temporaries.
+
+		Each instruction is a tuple beginning with an opcode, followed by slot
+		indices and any constants it needs. All values are plain integers reduced
+		modulo the field, rather than `FQ` instances.
+
+		For every command the range of instructions it emitted is recorded in
+		`ranges`, and the earlier linear combination temporaries it reads in
+		`reused`, so the instructions of only some commands can be executed.
+		"""
+		assert isinstance(state, State)
+		self.modulus = modulus
+		self.code = list()
+		self.slots = dict()
+		self.labels = list()
+		self.loads = list()
+		self.stores = list()
+		self.ranges = list()
+		self.reused = list()
+		self._lc_slots = dict()
+		for var in state.variables():
+			self.slots[var.idx] = len(self.labels)
+			self.labels.append(var.idx)
+		self.n_vars = len(self.labels)
+		self.n_slots = self.n_vars
+
+	@classmethod
+	def from_commands(cls, state, commands):
+		"""
+		Lower a list of commands, which have already been setup with the state
+		"""
+		tape = cls(state)
+		for cmd in commands:
+			start = len(tape.code)
+			tape.reused.append(set())
+			cmd.compile(state, tape)
+			tape.ranges.append((start, len(tape.code)))
+		tape.finish()
+		return tape
+
+	def finish(self):
+		# Linear combination temporaries are only valid while compiling
+		self._lc_slots = dict()
+		# Variables which aren't written by the tape must be loaded from the state
+		written = set(self.stores)
+		self.loads = [_ for _ in range(self.n_vars) if _ not in written]
+
+	def slot(self, state, idx):
+		"""
+		Slot of the variable at `idx` which the instruction being emitted will write to
+		"""
+		var = state[idx]
+		if not isinstance(var, Variable):
+			raise TypeError("Expected %r to be a variable, not %r" % (idx, type(var)))
+		slot = self.slots[var.idx]
+		self.stores.append(slot)
+		return slot
+
+	def operand(self, state, idx):
+		"""
+		Slot holding the value of `idx`, either a variable or a linear combination
+
+		Linear combinations are evaluated into a temporary slot the first time they
+		are used, as every variable is only assigned once all subsequent uses of the
+		same combination can re-use the temporary.
+		"""
+		thing = state[idx]
+		if isinstance(thing, Variable):
+			return self.slots[thing.idx]
+		assert isinstance(thing, Combination)
+		key = id(thing)
+		if key in self._lc_slots:
+			dst, ins, _ = self._lc_slots[key]
+			if ins is not None and self.reused:
+				self.reused[-1].add(ins)
+			return dst
+		slots, coeffs = self.lc_terms(thing)
+		ins = None
+		if len(slots) == 1 and coeffs[0] == 1:
+			dst = slots[0]
+		else:
+			dst = self.n_slots
+			self.n_slots += 1
+			self.labels.append(idx)
+			ins = len(self.code)
+			self.emit(OP_LC, dst, slots, coeffs)
+		# Keep a reference to the combination so its id remains unique
+		self._lc_slots[key] = (dst, ins, thing)
+		return dst
+
+	def terms(self, state, idx):
+		"""
+		Returns the slots and coefficients needed to read the value of `idx`
+		after the tape has been executed, see `read`
+		"""
+		thing = state[idx]
+		if isinstance(thing, Variable):
+			return (self.slots[thing.idx],), (1,)
+		return self.lc_terms(thing)
+
+	def read(self, values, terms):
+		slots, coeffs = terms
+		return sum([values[s] * c for s, c in zip(slots, coeffs)]) % self.modulus
+
+	def lc_terms(self, lc):
+		"""
+		Returns the slots and integer coefficients of a linear combination,
+		with the coefficients of duplicate variables merged
+		"""
+		merged = dict()
+		for term in lc:
+			slot = self.slots[term.var.idx]
+			merged[slot] = (merged.get(slot, 0) + int(term.coeff)) % self.modulus
+		slots = tuple(_ for _ in merged if merged[_] != 0)
+		return slots, tuple(merged[_] for _ in slots)
+
+	def emit(self, *instruction):
+		self.code.append(instruction)
+
+	def instructions(self, commands):
+		"""
+		Instructions emitted by the commands at the given indices, in order,
+		including the linear combination temporaries they reuse
+		"""
+		selected = set()
+		for i in commands:
+			start, end = self.ranges[i]
+			selected.update(range(start, end))
+			selected.update(self.reused[i])
+		code = self.code
+		return [code[_] for _ in sorted(selected)]
+
+	def new_values(self):
+		return [None] * self.n_slots
+
+	def load(self, state, slots=None):
+		"""
+		Returns a fresh list of slot values, populated from the variables which
+		aren't written by the tape and have been assigned values in the state
+		(e.g. inputs, secrets and the constant `ONE`), or from those of `slots`
+		"""
+		values = self.new_values()
+		labels = self.labels
+		for slot in (self.loads if slots is None else slots):
+			try:
+				values[slot] = int(state.var_value_get(labels[slot]))
+			except KeyError:
+				continue
+		return values
+
+	def store(self, state, values):
+		"""
+		Copy the values of all variables written by the tape back into the state
+		"""
+		labels = self.labels
+		state.var_values_replace([(labels[_], FQ(values[_])) for _ in self.stores])
+
+	def run(self, state):
+		values = self.load(state)
+		self.execute(values)
+		self.store(state, values)
+		return values
+
+	def execute(self, values, code=None):
+		"""
+		Evaluate every instruction in order, `values` is modified in-place.
+		When `code` is given only those instructions are evaluated.
+		"""
+		p = self.modulus
+		labels = self.labels
+		for ins in (self.code if code is None else code):
+			op = ins[0]
+			if op == OP_LC:
+				_, dst, slots, coeffs = ins
+				values[dst] = sum([values[s] * c for s, c in zip(slots, coeffs)]) % p
+			elif op == OP_MUL:
+				_, dst, a, b = ins
+				values[dst] = (values[a] * values[b]) % p
+			elif op == OP_SPLIT:
+				_, src, outputs = ins
+				# Little-endian binary string, bits beyond its length are zero
+				bits = bin(values[src])[:1:-1].ljust(len(outputs), '0')
+				for dst, bit in zip(outputs, bits):
+					values[dst] = BITS[bit]
+			elif op == OP_TABLE:
+				_, dst, inputs, lut = ins
+				idx = 0
+				for i, src in enumerate(inputs):
+					bit = values[src]
+					if bit != 0 and bit != 1:
+						raise RuntimeError("Variable %r expected to be binary" % (labels[src],))
+					idx |= bit << i
+				values[dst] = lut[idx]
+			elif op == OP_MUX:
+				_, dst_a, dst_b, a, b, sel = ins
+				bit = values[sel]
+				values[dst_a] = ((1 - bit) * values[a]) % p
+				values[dst_b] = (bit * values[b]) % p
+			elif op == OP_ZEROP:
+				_, src, dst_m, dst_y = ins
+				value = values[src]
+				values[dst_y] = 1 if value != 0 else 0
+				values[dst_m] = pow(value, p - 2, p)
+			elif op == OP_XOR or op == OP_AND or op == OP_OR:
+				_, dst, a, b = ins
+				x = values[a]
+				y = values[b]
+				if x != 0 and x != 1:
+					raise RuntimeError('Argument %r not binary' % (labels[a],))
+				if y != 0 and y != 1:
+					raise RuntimeError('Argument %r not binary' % (labels[b],))
+				if op == OP_XOR:
+					values[dst] = x ^ y
+				elif op == OP_AND:
+					values[dst] = x & y
+				else:
+					values[dst] = x | y
+			elif op == OP_ASSERT:
+				_, a, b, c = ins
+				if (values[a] * values[b]) % p != values[c]:
+					raise RuntimeError("Assertion failed!")
+			else:
+				raise RuntimeError("Unknown opcode %r" % (op,))
+		return values
@@ -0,0 +1,159 @@
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+from .tape import Tape, OP_LC, OP_MUL, OP_XOR, OP_AND, OP_OR, OP_ZEROP, OP_ASSERT, OP_SPLIT, OP_TABLE, OP_MUX
+
+
+# Fraction of table lookups in a tape above which vectorising pays off, see `python -m snarkil.bench`
+VECTOR_TABLE_FRACTION = 0.5
+
+
+def require_numpy():
+	if numpy is None:
+		raise RuntimeError("Vectorised evaluation requires numpy")
+
+
+def prefers_vector(tape):
+	"""
+	Whether the vectorised evaluator is expected to be faster than evaluating
+	each witness in turn. Arithmetic on columns of Python integers costs about
+	the same as on the integers themselves, so only table lookups, which become
+	a single numpy index per batch, are significantly faster.
+	"""
+	lookups = sum(1 for _ in tape.code if _[0] == OP_TABLE or _[0] == OP_MUX)
+	return lookups > len(tape.code) * VECTOR_TABLE_FRACTION
+
+
+def column(value, n):
+	"""
+	A column of `n` copies of the same value, or of `None` if it's unknown
+	"""
+	result = numpy.empty(n, dtype=object)
+	result.fill(value)
+	return result
+
+
+def column_from(values):
+	"""
+	A column holding one value for each witness
+	"""
+	result = numpy.empty(len(values), dtype=object)
+	result[:] = values
+	return result
+
+
+def columns_from(template, n):
+	"""
+	Broadcast a list of slot values from `Tape.load` to columns of `n` witnesses
+	"""
+	require_numpy()
+	return [None if _ is None else column(_, n) for _ in template]
+
+
+def lc_vector(columns, slots, coeffs, n, p):
+	if not slots:
+		return column(0, n)
+	acc = columns[slots[0]] * coeffs[0]
+	for s, c in zip(slots[1:], coeffs[1:]):
+		acc = acc + columns[s] * c
+	return acc % p
+
+
+def inverse_vector(values, p):
+	"""
+	Invert every element of a column, using Montgomery's trick to perform
+	a single modular exponentiation for the whole column. Zero maps to zero.
+	"""
+	n = len(values)
+	prefix = [1] * n
+	acc = 1
+	for i, x in enumerate(values):
+		prefix[i] = acc
+		if x != 0:
+			acc = (acc * x) % p
+	acc = pow(acc, p - 2, p)
+	result = column(0, n)
+	for i in range(n - 1, -1, -1):
+		x = values[i]
+		if x != 0:
+			result[i] = (acc * prefix[i]) % p
+			acc = (acc * x) % p
+	return result
+
+
+def execute_vector(tape, columns, n):
+	"""
+	Evaluate the tape for `n` witnesses at once, `columns` is modified in-place
+
+	Every slot holds a numpy array of integers, one for each witness, so each
+	instruction is dispatched once per batch rather than once per witness.
+	The arrays are of the `object` dtype as field elements don't fit into a
+	machine word, arithmetic on them is performed element-wise by numpy.
+	"""
+	assert isinstance(tape, Tape)
+	require_numpy()
+	p = tape.modulus
+	labels = tape.labels
+	for ins in tape.code:
+		op = ins[0]
+		if op == OP_LC:
+			_, dst, slots, coeffs = ins
+			columns[dst] = lc_vector(columns, slots, coeffs, n, p)
+		elif op == OP_MUL:
+			_, dst, a, b = ins
+			columns[dst] = (columns[a] * columns[b]) % p
+		elif op == OP_SPLIT:
+			_, src, outputs = ins
+			value = columns[src]
+			for i, dst in enumerate(outputs):
+				columns[dst] = (value >> i) & 1
+		elif op == OP_TABLE:
+			_, dst, inputs, lut = ins
+			idx = numpy.zeros(n, dtype=numpy.int64)
+			for i, src in enumerate(inputs):
+				bits = columns[src]
+				if ((bits != 0) & (bits != 1)).any():
+					raise RuntimeError("Variable %r expected to be binary" % (labels[src],))
+				idx |= bits.astype(numpy.int64) << i
+			columns[dst] = numpy.array(lut, dtype=object)[idx]
+		elif op == OP_MUX:
+			_, dst_a, dst_b, a, b, sel = ins
+			bits = columns[sel]
+			columns[dst_a] = ((1 - bits) * columns[a]) % p
+			columns[dst_b] = (bits * columns[b]) % p
+		elif op == OP_ZEROP:
+			_, src, dst_m, dst_y = ins
+			value = columns[src]
+			columns[dst_y] = (value != 0).astype(numpy.int64).astype(object)
+			columns[dst_m] = inverse_vector(value, p)
+		elif op == OP_XOR or op == OP_AND or op == OP_OR:
+			_, dst, a, b = ins
+			x = columns[a]
+			y = columns[b]
+			if ((x != 0) & (x != 1)).any():
+				raise RuntimeError('Argument %r not binary' % (labels[a],))
+			if ((y != 0) & (y != 1)).any():
+				raise RuntimeError('Argument %r not binary' % (labels[b],))
+			if op == OP_XOR:
+				columns[dst] = x ^ y
+			elif op == OP_AND:
+				columns[dst] = x & y
+			else:
+				columns[dst] = x | y
+		elif op == OP_ASSERT:
+			_, a, b, c = ins
+			if ((columns[a] * columns[b]) % p != columns[c]).any():
+				raise RuntimeError("Assertion failed!")
+		else:
+			raise RuntimeError("Unknown opcode %r" % (op,))
+	return columns
+
+
+def read_vector(tape, columns, terms, n):
+	"""
+	Column of values for an output, given the terms from `Tape.terms`
+	"""
+	slots, coeffs = terms
+	return lc_vector(columns, slots, coeffs, n, tape.modulus)
@@ -0,0 +1,114 @@
+import sys
+import mmap
+import struct
+from array import array
+
+from .binary import BinaryFormatError, wire_id
+from .sparse import FIELD_BYTES
+
+
+INPUTS_MAGIC = b'SNKINPT\x00'
+INPUTS_VERSION = 1
+
+WITNESS_MAGIC = b'SNKWTNS\x00'
+WITNESS_VERSION = 1
+
+# Shared by both files: magic, version, number of values, padded so the values are 32 byte aligned
+HEADER = struct.Struct('<8sIQ12x')
+
+# Number of values encoded before each write
+CHUNK_SIZE = 4096
+
+
+def write_inputs(handle, wires, values):
+	"""
+	Write values for the wires to a binary input file
+
+	After the header follows every value as a 32 byte little-endian field
+	element, then the wire ID of each value as a 32bit little-endian integer.
+	"""
+	handle.write(HEADER.pack(INPUTS_MAGIC, INPUTS_VERSION, len(values)))
+	handle.write(b''.join(int(_).to_bytes(FIELD_BYTES, 'little') for _ in values))
+	ids = array('I', [wire_id(_) for _ in wires])
+	if sys.byteorder != 'little':
+		ids.byteswap()
+	handle.write(ids.tobytes())
+
+
+def write_witness(handle, count, values):
+	"""
+	Write `count` values to a binary witness file as they're produced by the
+	`values` iterable, rather than holding the whole witness in memory
+
+	After the header follows every value as a 32 byte little-endian field element.
+	"""
+	handle.write(HEADER.pack(WITNESS_MAGIC, WITNESS_VERSION, count))
+	written = 0
+	chunk = []
+	for value in values:
+		chunk.append(int(value).to_bytes(FIELD_BYTES, 'little'))
+		if len(chunk) == CHUNK_SIZE:
+			handle.write(b''.join(chunk))
+			written += len(chunk)
+			chunk = []
+	handle.write(b''.join(chunk))
+	written += len(chunk)
+	if written != count:
+		raise ValueError("Expected %d witness values, got %d" % (count, written))
+
+
+def is_input_file(path):
+	with open(path, 'rb') as handle:
+		return handle.read(len(INPUTS_MAGIC)) == INPUTS_MAGIC
+
+
+class InputFile(object):
+	__slots__ = ('_handle', '_mmap', '_view', 'wires')
+
+	def __init__(self, path):
+		"""
+		A binary input file, memory-mapped read-only
+
+		Values are decoded from the mapping as they're iterated, without
+		reading the file into memory or parsing any text.
+		"""
+		self._handle = open(path, 'rb')
+		self._mmap = mmap.mmap(self._handle.fileno(), 0, access=mmap.ACCESS_READ)
+		magic, version, count = HEADER.unpack_from(self._mmap, 0)
+		if magic != INPUTS_MAGIC:
+			raise BinaryFormatError("Not a binary input file")
+		if version != INPUTS_VERSION:
+			raise BinaryFormatError("Unsupported binary input file version %d" % (version,))
+		begin = HEADER.size
+		end = begin + (count * FIELD_BYTES)
+		if len(self._mmap) != end + (count * 4):
+			raise BinaryFormatError("Binary input file is truncated")
+		self._view = memoryview(self._mmap)[begin:end]
+		ids = array('I', self._mmap[end:end + (count * 4)])
+		if sys.byteorder != 'little':
+			ids.byteswap()
+		self.wires = [str(_) for _ in ids]
+
+	def __len__(self):
+		return len(self.wires)
+
+	def __getitem__(self, i):
+		offset = i * FIELD_BYTES
+		return int.from_bytes(self._view[offset:offset + FIELD_BYTES], 'little')
+
+	def __iter__(self):
+		view = self._view
+		for offset in range(0, len(view), FIELD_BYTES):
+			yield int.from_bytes(view[offset:offset + FIELD_BYTES], 'little')
+
+	def close(self):
+		self._view.release()
+		self._mmap.close()
+		self._handle.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+